@@ -0,0 +1,44 @@
+import argparse
+import timeit
+
+from stentorian.codec import available_codecs
+
+from grammars import large_grammar, recognition_event
+
+
+def bench(label, fn, number):
+    t = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print('  {:<28} {:10.1f} us'.format(label, t * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare JSON codecs on realistic payloads.')
+    parser.add_argument('--commands', type=int, default=2000)
+    parser.add_argument('--words', type=int, default=40)
+    parser.add_argument('--number', type=int, default=20)
+    args = parser.parse_args()
+
+    load = {"jsonrpc": "2.0", "method": "command_grammar_load", "id": 1,
+            "params": [large_grammar(args.commands).serialize()]}
+    notification = {"jsonrpc": "2.0",
+                    "method": "command_grammar_notification",
+                    "params": recognition_event(args.words)}
+
+    for codec in available_codecs():
+        load_bytes = codec.encode(load)
+        notification_bytes = codec.encode(notification)
+
+        print('{} (grammar: {} bytes, notification: {} bytes)'.format(
+            codec.name, len(load_bytes), len(notification_bytes)))
+        bench('encode grammar load', lambda: codec.encode(load), args.number)
+        bench('decode grammar load',
+              lambda: codec.decode(load_bytes), args.number)
+        bench('encode notification',
+              lambda: codec.encode(notification), args.number * 100)
+        bench('decode notification',
+              lambda: codec.decode(notification_bytes), args.number * 100)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import argparse
+import time
+
+from stentorian.codec import default_codec
+from stentorian.engine import connect
+from stentorian.grammar import Grammar, Rule
+from stentorian.util import SimpleCallback
+
+from grammars import large_mapping
+
+
+def build(n, factor):
+    return Grammar([Rule(large_mapping(n, factor=factor), exported=True)])
+
+
+def measure(engine, grammar):
+    codec = default_codec()
+
+    start = time.perf_counter()
+    size = len(grammar.encode(codec))
+    serialize = time.perf_counter() - start
+
+    load = None
+    if engine is not None:
+        start = time.perf_counter()
+        control = engine.command_grammar_load(grammar, SimpleCallback(print))
+        load = time.perf_counter() - start
+        control.unload()
+
+    return size, serialize, load
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Effect of prefix factoring on large mappings.')
+    parser.add_argument('--commands', type=int, default=5000)
+    parser.add_argument('--host', help='server to measure load latency on')
+    parser.add_argument('--port', type=int)
+    args = parser.parse_args()
+
+    engine = connect(args.host, args.port) if args.host else None
+
+    results = {}
+    for factor in [False, True]:
+        results[factor] = measure(engine, build(args.commands, factor))
+
+    print('{} commands'.format(args.commands))
+    print('  {:<10} {:>12} {:>14} {:>10}'.format(
+        '', 'bytes', 'serialize ms', 'load ms'))
+    for factor, (size, serialize, load) in results.items():
+        print('  {:<10} {:>12} {:>14.1f} {:>10}'.format(
+            'factored' if factor else 'flat', size, serialize * 1e3,
+            '-' if load is None else '{:.1f}'.format(load * 1e3)))
+
+    flat, factored = results[False], results[True]
+    print('size reduced by {:.1f}%'.format(
+        100 * (1 - factored[0] / flat[0])))
+    if engine is not None:
+        print('load latency reduced by {:.1f}%'.format(
+            100 * (1 - factored[2] / flat[2])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+from grammars import large_grammar
+
+
+def rss_bytes():
+    # current resident set size, where the platform makes it available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # peak rather than current; kilobytes on Linux, bytes on macOS
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def count_elements(grammar):
+    seen = set()
+    counts = {}
+    to_visit = [r.definition for r in grammar.rules]
+    while to_visit:
+        e = to_visit.pop()
+        if id(e) in seen:
+            continue
+        seen.add(id(e))
+        name = type(e).__name__
+        counts[name] = counts.get(name, 0) + 1
+        to_visit.extend(e.children)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Memory used by the element tree of a large grammar.')
+    parser.add_argument('--commands', type=int, default=50000)
+    args = parser.parse_args()
+
+    gc.collect()
+    rss_before = rss_bytes()
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    grammar = large_grammar(args.commands)
+
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    allocated, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = rss_bytes()
+
+    counts = count_elements(grammar)
+    total = sum(counts.values())
+
+    print('commands:          {}'.format(args.commands))
+    print('construction time: {:.2f} s'.format(elapsed))
+    print('elements:          {}'.format(total))
+    for name, n in sorted(counts.items(), key=lambda kv: -kv[1]):
+        print('  {:<16} {}'.format(name, n))
+    print('allocated:         {:.1f} MiB'.format(allocated / 2 ** 20))
+    print('bytes per element: {:.1f}'.format(allocated / total))
+    if rss_before is not None:
+        print('total RSS:         {:.1f} MiB (+{:.1f} MiB)'.format(
+            rss_after / 2 ** 20, (rss_after - rss_before) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import argparse
+import threading
+import time
+
+from stentorian import fakeserver
+from stentorian.dispatch import InlineDispatcher
+from stentorian.engine import Engine
+from stentorian.grammar import Grammar, Rule, List
+from stentorian.protocol import ConnectionLost
+from stentorian.util import SimpleCallback, mapping
+
+from grammars import large_grammar, recognition_event
+
+
+def report(label, n, seconds, unit):
+    print('  {:<28} {:10.1f} ms {:12.0f} {}/s'.format(
+        label, seconds * 1e3, n / seconds, unit))
+
+
+def bench_grammar_load(engine, args):
+    grammar = large_grammar(args.commands)
+    grammar.serialize()
+
+    start = time.perf_counter()
+    for _ in range(args.loads):
+        control = engine.command_grammar_load(grammar, SimpleCallback(print))
+        control.unload()
+    report('grammar load/unload', args.loads,
+           time.perf_counter() - start, 'loads')
+
+
+def bench_bulk_load(engine, args):
+    for label in ['one by one', 'load_grammars()']:
+        grammars = [large_grammar(args.commands // 10, seed=i)
+                    for i in range(args.loads)]
+
+        start = time.perf_counter()
+        if label == 'one by one':
+            controls = [engine.command_grammar_load(g, SimpleCallback(print))
+                        for g in grammars]
+        else:
+            controls = engine.load_grammars(
+                [(g, SimpleCallback(print)) for g in grammars])
+        report('{} grammars {}'.format(args.loads, label), args.loads,
+               time.perf_counter() - start, 'loads')
+
+        for c in controls:
+            c.unload()
+
+
+def _list_grammar():
+    words = List()
+    grammar = Grammar([Rule(mapping({'pick <w>': lambda c: None},
+                                    {'w': words}), exported=True)])
+    return grammar, words
+
+
+def bench_list_churn(engine, args):
+    grammar, words = _list_grammar()
+    control = engine.command_grammar_load(grammar, SimpleCallback(print))
+
+    start = time.perf_counter()
+    for i in range(args.updates):
+        control.list_append(words, 'word{}'.format(i))
+    for i in range(args.updates):
+        control.list_remove(words, 'word{}'.format(i))
+    report('list append/remove', 2 * args.updates,
+           time.perf_counter() - start, 'calls')
+
+    start = time.perf_counter()
+    for i in range(args.updates // 100):
+        control.list_set(words, ['word{}'.format(j)
+                                 for j in range(i, i + 100)])
+    report('list_set (100 words)', args.updates // 100,
+           time.perf_counter() - start, 'sets')
+
+    control.unload()
+
+
+def bench_activation(engine, args):
+    grammar = Grammar([Rule(mapping({'rule {}'.format(i): lambda c: None}),
+                            exported=True)
+                       for i in range(10)])
+    control = engine.command_grammar_load(grammar, SimpleCallback(print))
+
+    start = time.perf_counter()
+    for i in range(args.updates):
+        control.rule_activate(grammar.rules[i % 10])
+        control.rule_deactivate(grammar.rules[i % 10])
+    report('rule activate/deactivate', 2 * args.updates,
+           time.perf_counter() - start, 'calls')
+
+    start = time.perf_counter()
+    for _ in range(args.updates // 10):
+        control.rule_activate_all()
+        control.rule_deactivate_all()
+    report('activate/deactivate all', 2 * (args.updates // 10),
+           time.perf_counter() - start, 'batches')
+
+    control.unload()
+
+
+def bench_notifications(engine, server, args):
+    received = []
+    done = threading.Event()
+
+    def phrase_finish(result):
+        received.append(result)
+        if len(received) == args.notifications:
+            done.set()
+
+    grammar, _words = _list_grammar()
+    control = engine.command_grammar_load(grammar,
+                                          SimpleCallback(phrase_finish))
+
+    worker = threading.Thread(target=_process, args=(engine,), daemon=True)
+    worker.start()
+
+    event = recognition_event(10)[1]
+    start = time.perf_counter()
+    for i in range(0, args.notifications, 1000):
+        n = min(1000, args.notifications - i)
+        server.notify_many('command_grammar_notification',
+                           control.grammar_id, [event] * n)
+    done.wait()
+    report('notifications', args.notifications,
+           time.perf_counter() - start, 'events')
+
+
+def _process(engine):
+    try:
+        engine.process_notifications(InlineDispatcher())
+    except ConnectionLost:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Client throughput against the stand-in server.')
+    parser.add_argument('--commands', type=int, default=2000,
+                        help='size of the grammar that is loaded')
+    parser.add_argument('--loads', type=int, default=20)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--notifications', type=int, default=50000)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='simulated server latency in seconds')
+    args = parser.parse_args()
+
+    sock, server = fakeserver.start(latency=args.latency)
+    with Engine(sock) as engine:
+        print('stand-in server, {:.1f} ms latency'.format(args.latency * 1e3))
+        bench_grammar_load(engine, args)
+        bench_bulk_load(engine, args)
+        bench_list_churn(engine, args)
+        bench_activation(engine, args)
+        bench_notifications(engine, server, args)
+
+
+if __name__ == '__main__':
+    main()
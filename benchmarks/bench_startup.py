@@ -0,0 +1,51 @@
+import argparse
+import tempfile
+import time
+
+from stentorian import bundle, elementparser
+from stentorian.grammar import Grammar, Rule
+
+from grammars import command_specs, large_mapping
+
+
+def timed(label, fn):
+    start = time.perf_counter()
+    result = fn()
+    print('  {:<26} {:8.1f} ms'.format(
+        label, (time.perf_counter() - start) * 1e3))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Grammar construction time for large mappings.')
+    parser.add_argument('--commands', type=int, default=20000)
+    args = parser.parse_args()
+
+    print('{} commands'.format(args.commands))
+
+    for label in ['cold spec cache', 'warm spec cache']:
+        if label.startswith('cold'):
+            elementparser.clear_caches()
+
+        print(label)
+        mapping = timed('mapping()', lambda: large_mapping(args.commands))
+        grammar = timed('Grammar()',
+                        lambda: Grammar([Rule(mapping, exported=True)]))
+        timed('serialize()', grammar.serialize)
+        timed('compile()', grammar.compile)
+
+    specs = command_specs(args.commands)
+
+    def build():
+        return Grammar([Rule(large_mapping(args.commands), exported=True)])
+
+    with tempfile.TemporaryDirectory() as directory:
+        for label in ['bundle, cold', 'bundle, warm']:
+            print(label)
+            timed('load_or_build()', lambda: bundle.load_or_build(
+                directory, specs, build))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import random
+
+from stentorian.grammar import Grammar, Rule, List, Dictation
+from stentorian.util import mapping, choice
+
+
+VERBS = ['go', 'select', 'delete', 'copy', 'move', 'open', 'close', 'find',
+         'show', 'hide', 'switch', 'jump', 'insert', 'replace', 'toggle']
+OBJECTS = ['line', 'word', 'file', 'window', 'tab', 'buffer', 'paragraph',
+           'function', 'class', 'block', 'symbol', 'error', 'match', 'mark']
+MODIFIERS = ['next', 'previous', 'first', 'last', 'current', 'all', 'other']
+
+
+def numbers():
+    return choice({str(i): i for i in range(100)})
+
+
+def command_specs(n, seed=0):
+    rng = random.Random(seed)
+    specs = set()
+    while len(specs) < n:
+        parts = [rng.choice(VERBS)]
+        if rng.random() < 0.5:
+            parts.append(rng.choice(MODIFIERS))
+        parts.append(rng.choice(OBJECTS))
+        parts.append('w' + str(len(specs)))
+        r = rng.random()
+        if r < 0.2:
+            parts.append('<n>')
+        elif r < 0.3:
+            parts.append('[<text>]')
+        specs.add(' '.join(parts))
+    return sorted(specs)
+
+
+def ignore(_captures):
+    # a module level handler, so grammars using it can be bundled
+    return None
+
+
+def large_mapping(n, seed=0, **kwargs):
+    commands = {spec: ignore for spec in command_specs(n, seed)}
+    captures = {'n': numbers(), 'text': Dictation()}
+    return mapping(commands, captures, **kwargs)
+
+
+def large_grammar(n, seed=0, **kwargs):
+    return Grammar([
+        Rule(large_mapping(n, seed, **kwargs), exported=True),
+        Rule(List(initial=['alpha', 'beta', 'gamma']), exported=True),
+    ])
+
+
+def recognition_event(n_words, seed=0):
+    # a command_grammar_notification payload shaped like the server's
+    rng = random.Random(seed)
+    words = [{"text": rng.choice(VERBS + OBJECTS), "rule": 1}
+             for _ in range(n_words)]
+    children = [{"name": "leaf", "slice": [i, i + 1], "children": []}
+                for i in range(n_words)]
+    match = {"name": "rule_0", "slice": [0, n_words], "children": [
+        {"name": "seq", "slice": [0, n_words], "children": children}]}
+    return [0, {"type": "phrase_finish", "result": [words, [match]]}]
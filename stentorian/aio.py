@@ -0,0 +1,428 @@
+import asyncio
+import logging
+
+from .codec import default_codec
+from .protocol import RemoteError, ConnectionLost, RequestTimeout
+from .engine import CallbackManager, GrammarCallback, make_parse_tree
+
+
+logger = logging.getLogger(__name__)
+
+# notifications for large grammars can be long lines
+STREAM_LIMIT = 2 ** 24
+
+
+class AsyncJsonRpcClient(object):
+    def __init__(self, reader, writer, codec=None, timeout=None):
+        self.reader = reader
+        self.writer = writer
+        self.codec = codec if codec is not None else default_codec()
+        self.notifications = asyncio.Queue()
+
+        # default deadline in seconds for awaited requests
+        self.timeout = timeout
+
+        self.pending_calls = {}
+        self.id_counter = 0
+        self.closed = False
+
+        self.receive_task = asyncio.ensure_future(self._receive_worker())
+
+    async def _receive_worker(self):
+        try:
+            while True:
+                msg = await self.reader.readline()
+                if not msg:
+                    return
+
+                obj = self.codec.decode(msg)
+                responses = obj if isinstance(obj, list) else [obj]
+
+                for r in responses:
+                    if 'id' not in r:
+                        # it's a notification
+                        await self.notifications.put(
+                            (r['method'], r['params']))
+                    else:
+                        future = self.pending_calls.pop(r['id'], None)
+                        if future is not None:
+                            _settle(future, r)
+        except OSError:
+            logger.debug('connection to server closed', exc_info=True)
+        except Exception:
+            logger.exception('error while receiving from server')
+        finally:
+            self._connection_lost()
+
+    def _connection_lost(self):
+        self.closed = True
+
+        pending = list(self.pending_calls.values())
+        self.pending_calls.clear()
+
+        for future in pending:
+            if not future.done():
+                future.set_exception(
+                    ConnectionLost('connection to server lost'))
+
+        self.notifications.put_nowait(None)
+
+    def request_future(self, method, *args, **kwargs):
+        # The request is written immediately, so several calls can be
+        # in flight without awaiting each one in turn. Callers issuing
+        # many of them should await drain() now and then.
+        _msg_id, future = self._send(method, args, kwargs)
+        return future
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def _send(self, method, args, kwargs):
+        assert not args or not kwargs
+
+        if self.closed:
+            raise ConnectionLost('connection to server lost')
+
+        self.id_counter += 1
+        msg_id = self.id_counter
+
+        call = {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": kwargs or args,
+            "id": msg_id,
+        }
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending_calls[msg_id] = future
+
+        self.writer.write(self.codec.encode(call) + b'\n')
+
+        return msg_id, future
+
+    async def request(self, method, *args, **kwargs):
+        msg_id, future = self._send(method, args, kwargs)
+        try:
+            # waits while the write buffer is full, so that a fast
+            # caller can't make it grow without bounds
+            await self.drain()
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise RequestTimeout('no response within {} seconds'.format(
+                self.timeout)) from None
+        finally:
+            self.pending_calls.pop(msg_id, None)
+
+    def cancel_all(self):
+        for future in self.pending_calls.values():
+            future.cancel()
+        self.pending_calls.clear()
+
+    async def get_notification(self):
+        notification = await self.notifications.get()
+        if notification is None:
+            # leave the marker for any other consumer
+            self.notifications.put_nowait(None)
+            raise ConnectionLost('connection to server lost')
+
+        return notification
+
+    async def close(self):
+        self.receive_task.cancel()
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+def _settle(future, response):
+    if future.cancelled():
+        return
+
+    if 'result' in response:
+        future.set_result(response['result'])
+    else:
+        e = response['error']
+        future.set_exception(RemoteError(code=e['code'],
+                                         message=e['message'],
+                                         data=e.get('data')))
+
+
+async def connect(host, port):
+    logger.info('attempting to connect to server')
+    reader, writer = await asyncio.open_connection(
+        host, port, limit=STREAM_LIMIT)
+    logger.info('successfully connected to server')
+    engine = AsyncEngine(AsyncJsonRpcClient(reader, writer))
+    logger.info('waiting for user profile to be selected')
+    await wait_for_user(engine)
+    logger.info('user profile selected')
+    return engine
+
+
+async def wait_for_user(engine):
+    while await engine.get_current_user() is None:
+        logger.debug('get_current_user returned None, retrying...')
+        await asyncio.sleep(1)
+
+
+class AsyncCommandGrammarControl(object):
+    def __init__(self, engine, grammar_id, rules):
+        self.grammar_id = grammar_id
+        self.engine = engine
+        self.rules = rules
+
+    # The control methods return futures rather than being coroutines,
+    # so they can also be called from the synchronous Element.on_load
+    # hooks.
+
+    def rule_activate(self, rule):
+        return self.engine._request('command_grammar_rule_activate',
+                                    self.grammar_id, rule.name)
+
+    def rule_deactivate(self, rule):
+        return self.engine._request('command_grammar_rule_deactivate',
+                                    self.grammar_id, rule.name)
+
+    def rule_activate_all(self):
+        return asyncio.gather(*[self.rule_activate(r) for r in self.rules])
+
+    def rule_deactivate_all(self):
+        return asyncio.gather(*[self.rule_deactivate(r) for r in self.rules])
+
+    def list_append(self, grammar_list, word):
+        return self.engine._request('command_grammar_list_append',
+                                    self.grammar_id, grammar_list.name, word)
+
+    def list_remove(self, grammar_list, word):
+        return self.engine._request('command_grammar_list_remove',
+                                    self.grammar_id, grammar_list.name, word)
+
+    def list_clear(self, grammar_list):
+        return self.engine._request('command_grammar_list_clear',
+                                    self.grammar_id, grammar_list.name)
+
+    async def unload(self):
+        await self.engine._command_grammar_unload(self.grammar_id)
+
+
+class AsyncSelectGrammarControl(object):
+    def __init__(self, engine, grammar_id):
+        self.grammar_id = grammar_id
+        self.engine = engine
+
+    def activate(self):
+        return self.engine._request('select_grammar_activate',
+                                    self.grammar_id)
+
+    def deactivate(self):
+        return self.engine._request('select_grammar_deactivate',
+                                    self.grammar_id)
+
+    def text_set(self, text):
+        return self.engine._request('select_grammar_text_set',
+                                    self.grammar_id, text)
+
+    def text_get(self):
+        return self.engine._request('select_grammar_text_get',
+                                    self.grammar_id)
+
+    def text_change(self, start, stop, text):
+        return self.engine._request('select_grammar_text_change',
+                                    self.grammar_id, start, stop, text)
+
+    def text_insert(self, start, text):
+        return self.engine._request('select_grammar_text_insert',
+                                    self.grammar_id, start, text)
+
+    def text_delete(self, start, stop):
+        return self.engine._request('select_grammar_text_delete',
+                                    self.grammar_id, start, stop)
+
+    async def unload(self):
+        await self.engine._select_grammar_unload(self.grammar_id)
+
+
+class AsyncDictationGrammarControl(object):
+    def __init__(self, engine, grammar_id):
+        self.grammar_id = grammar_id
+        self.engine = engine
+
+    def activate(self):
+        return self.engine._request('dictation_grammar_activate',
+                                    self.grammar_id)
+
+    def deactivate(self):
+        return self.engine._request('dictation_grammar_deactivate',
+                                    self.grammar_id)
+
+    def context(self, text):
+        return self.engine._request('dictation_grammar_context_set',
+                                    self.grammar_id, text)
+
+    async def unload(self):
+        await self.engine._dictation_grammar_unload(self.grammar_id)
+
+
+class AsyncCatchallGrammarControl(object):
+    def __init__(self, engine, grammar_id):
+        self.grammar_id = grammar_id
+        self.engine = engine
+
+    def activate(self):
+        return self.engine._request('catchall_grammar_activate',
+                                    self.grammar_id)
+
+    def deactivate(self):
+        return self.engine._request('catchall_grammar_deactivate',
+                                    self.grammar_id)
+
+    async def unload(self):
+        await self.engine._catchall_grammar_unload(self.grammar_id)
+
+
+class AsyncEngineRegistration(object):
+    def __init__(self, engine_id, engine):
+        self.engine_id = engine_id
+        self.engine = engine
+
+    async def unregister(self):
+        await self.engine._engine_unregister(self.engine_id)
+
+
+class AsyncEngine(object):
+    def __init__(self, client):
+        self.client = client
+
+        self.command_grammars = CallbackManager()
+        self.select_grammars = CallbackManager()
+        self.dictation_grammars = CallbackManager()
+        self.catchall_grammars = CallbackManager()
+        self.engine_registrations = CallbackManager()
+
+        self.managers = {
+            "command_grammar_notification": self.command_grammars,
+            "select_grammar_notification": self.select_grammars,
+            "dictation_grammar_notification": self.dictation_grammars,
+            "catchall_grammar_notification": self.catchall_grammars,
+            "engine_notification": self.engine_registrations,
+        }
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, ty, value, tb):
+        await self.client.close()
+
+    def _request(self, *args, **kwargs):
+        return self.client.request_future(*args, **kwargs)
+
+    async def register(self, callback):
+        e = await self.client.request('engine_register')
+        self.engine_registrations.add_callback(e, callback)
+        return AsyncEngineRegistration(e, self)
+
+    async def _engine_unregister(self, engine_id):
+        await self.client.request('engine_unregister', engine_id)
+        self.engine_registrations.remove_callback(engine_id)
+
+    async def command_grammar_load(self, grammar, callback):
+        g = await self.client.request('command_grammar_load',
+                                      grammar.serialize())
+
+        rule_names = [r for r in grammar.rules if r.exported]
+        control = AsyncCommandGrammarControl(self, g, rule_names)
+
+        self.command_grammars.add_callback(
+            g, GrammarCallback(control, callback, transform=make_parse_tree))
+
+        # the on_load hooks only issue requests, so wait for all of
+        # them together
+        issued = []
+        collector = _CollectingControl(control, issued)
+        grammar.on_load(collector)
+        await asyncio.gather(*issued)
+
+        return control
+
+    async def _command_grammar_unload(self, grammar_id):
+        await self.client.request('command_grammar_unload', grammar_id)
+        self.command_grammars.remove_callback(grammar_id)
+
+    async def select_grammar_load(self, select_words, through_words,
+                                  callback):
+        g = await self.client.request('select_grammar_load',
+                                      select_words, through_words)
+
+        control = AsyncSelectGrammarControl(self, g)
+
+        self.select_grammars.add_callback(
+            g, GrammarCallback(control, callback))
+
+        return control
+
+    async def _select_grammar_unload(self, grammar_id):
+        await self.client.request('select_grammar_unload', grammar_id)
+        self.select_grammars.remove_callback(grammar_id)
+
+    async def dictation_grammar_load(self, callback):
+        g = await self.client.request('dictation_grammar_load')
+        control = AsyncDictationGrammarControl(self, g)
+        self.dictation_grammars.add_callback(
+            g, GrammarCallback(control, callback))
+        return control
+
+    async def _dictation_grammar_unload(self, grammar_id):
+        await self.client.request('dictation_grammar_unload', grammar_id)
+        self.dictation_grammars.remove_callback(grammar_id)
+
+    async def catchall_grammar_load(self, callback):
+        g = await self.client.request('catchall_grammar_load')
+        control = AsyncCatchallGrammarControl(self, g)
+        self.catchall_grammars.add_callback(
+            g, GrammarCallback(control, callback))
+        return control
+
+    async def _catchall_grammar_unload(self, grammar_id):
+        await self.client.request('catchall_grammar_unload', grammar_id)
+        self.catchall_grammars.remove_callback(grammar_id)
+
+    async def microphone_set_state(self, state):
+        await self.client.request('microphone_set_state', state)
+
+    async def microphone_get_state(self):
+        return await self.client.request('microphone_get_state')
+
+    async def get_current_user(self):
+        return await self.client.request('get_current_user')
+
+    async def notifications(self):
+        while True:
+            yield await self.client.get_notification()
+
+    async def process_notifications(self):
+        async for method, params in self.notifications():
+            cb_manager = self.managers[method]
+            entity_id, event = params
+            result = cb_manager.handle_callback(entity_id, event)
+
+            # handlers may be coroutines
+            if asyncio.iscoroutine(result):
+                await result
+
+
+class _CollectingControl(object):
+    def __init__(self, control, issued):
+        self._control = control
+        self._issued = issued
+
+    def __getattr__(self, name):
+        attr = getattr(self._control, name)
+        if not callable(attr):
+            return attr
+
+        def collect(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if asyncio.isfuture(result):
+                self._issued.append(result)
+            return result
+
+        return collect
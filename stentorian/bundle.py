@@ -0,0 +1,167 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import pickle
+import tempfile
+
+from .codec import default_codec
+from .grammar import Rule, Tag, List
+
+
+logger = logging.getLogger(__name__)
+
+
+# Grammar bundles
+#
+# Building a large grammar means parsing every spec, building the
+# element tree, sorting the rules and serializing it. A bundle stores
+# the finished grammar on disk: the element tree with its rule, tag and
+# list names, and its serialized and encoded wire form. Loading it
+# takes a single read and skips all of that.
+#
+# Handlers are Python callables. Module level functions and classes are
+# stored by reference, like pickle always does. Anything else, such as
+# lambdas and closures, must be given a stable key in the handlers
+# dict, both when saving and when loading, and is stored as that key.
+# The commands dict passed to mapping() works well for this, with the
+# specs as keys.
+#
+# The evaluators are closures as well, so they are compiled again the
+# first time the grammar is evaluated.
+#
+# Loading a bundle unpickles it, which can run arbitrary code, so the
+# bundle directory must be one that only trusted users can write to.
+
+# bumped whenever the layout of grammars or elements changes, so that
+# bundles written by an older version are rebuilt
+FORMAT = 2
+
+
+class BundleError(Exception):
+    pass
+
+
+def source_hash(source):
+    # Identifies the definitions a grammar is built from. source is
+    # anything JSON can encode, like the specs of its mappings, or
+    # bytes, like the text of the module that builds it.
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    if not isinstance(source, bytes):
+        source = json.dumps(source, sort_keys=True,
+                            separators=(',', ':')).encode('utf-8')
+
+    h = hashlib.sha256(b'stentorian-bundle-%d\n' % FORMAT)
+    h.update(source)
+    return h.hexdigest()
+
+
+class _BundlePickler(pickle.Pickler):
+    def __init__(self, file, handlers):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        # by identity, since handlers need not be hashable
+        self.keys = {id(h): k for k, h in handlers.items()}
+
+    def persistent_id(self, obj):
+        key = self.keys.get(id(obj))
+        if key is None:
+            return None
+        return ('handler', key)
+
+
+class _BundleUnpickler(pickle.Unpickler):
+    def __init__(self, file, handlers):
+        super().__init__(file)
+        self.handlers = handlers
+
+    def persistent_load(self, pid):
+        _kind, key = pid
+        try:
+            return self.handlers[key]
+        except KeyError:
+            raise BundleError('no handler for key {!r}'.format(key))
+
+
+def save(grammar, path, handlers=None):
+    if handlers is None:
+        handlers = {}
+
+    # so that loading the bundle doesn't have to
+    grammar.precompute(default_codec())
+
+    bundle = {
+        'format': FORMAT,
+        'counters': (Rule.rule_counter, Tag.tag_counter, List.counter),
+        'grammar': grammar,
+    }
+
+    # written to a temporary file first, so that a crash can't leave a
+    # partial bundle behind
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            try:
+                _BundlePickler(f, handlers).dump(bundle)
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                raise BundleError(
+                    'cannot store grammar, a handler may need a key: '
+                    '{}'.format(e))
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def load(path, handlers=None):
+    if handlers is None:
+        handlers = {}
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    try:
+        bundle = _BundleUnpickler(io.BytesIO(data), handlers).load()
+    except BundleError:
+        raise
+    except Exception as e:
+        raise BundleError('cannot read grammar bundle {}: {}'.format(
+            path, e))
+
+    if bundle.get('format') != FORMAT:
+        raise BundleError('grammar bundle {} has an old format'.format(path))
+
+    # names created from now on must not clash with the restored ones
+    rules, tags, lists = bundle['counters']
+    Rule.rule_counter = max(Rule.rule_counter, rules)
+    Tag.tag_counter = max(Tag.tag_counter, tags)
+    List.counter = max(List.counter, lists)
+
+    return bundle['grammar']
+
+
+def load_or_build(directory, source, build, handlers=None):
+    # Loads the bundle for source from directory, or calls build() to
+    # build the grammar and stores it for the next time. A bundle that
+    # can't be read is built again; a grammar that can't be stored is
+    # still returned.
+    path = os.path.join(directory, source_hash(source) + '.grammar')
+
+    try:
+        return load(path, handlers)
+    except FileNotFoundError:
+        pass
+    except (BundleError, OSError) as e:
+        logger.warning('rebuilding grammar: %s', e)
+
+    grammar = build()
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        save(grammar, path, handlers)
+    except (BundleError, OSError) as e:
+        logger.warning('grammar bundle not stored: %s', e)
+
+    return grammar
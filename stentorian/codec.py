@@ -0,0 +1,67 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class Encoded(object):
+    # A value that has already been encoded. It is spliced into the
+    # message as is, so it can be encoded once and sent many times.
+    def __init__(self, data):
+        self.data = data
+
+
+# Codecs turn JSON-RPC messages into the UTF-8 encoded bytes that go on
+# the wire and back. The line framing never splits inside a message,
+# so decoding works directly on the received bytes.
+
+class StdlibCodec(object):
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(object):
+    name = 'orjson'
+
+    def encode(self, obj):
+        return orjson.dumps(obj)
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class UjsonCodec(object):
+    name = 'ujson'
+
+    def encode(self, obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    def decode(self, data):
+        return ujson.loads(data)
+
+
+def available_codecs():
+    codecs = []
+    if orjson is not None:
+        codecs.append(OrjsonCodec())
+    if ujson is not None:
+        codecs.append(UjsonCodec())
+    codecs.append(StdlibCodec())
+    return codecs
+
+
+def default_codec():
+    # the fastest codec that is installed
+    return available_codecs()[0]
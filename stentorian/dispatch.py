@@ -0,0 +1,74 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class InlineDispatcher(object):
+    # runs every callback on the thread that processes notifications
+    def dispatch(self, _key, callback, *args):
+        callback(*args)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class ParallelDispatcher(object):
+    # Runs callbacks on a thread pool. Callbacks with the same key, such
+    # as the notifications of one grammar, run one at a time in the
+    # order they were dispatched, while callbacks with different keys
+    # run concurrently. At most max_pending callbacks can be waiting or
+    # running; beyond that, dispatch blocks until one has finished.
+    def __init__(self, max_workers=4, max_pending=1024):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='stentorian')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+        # keys with callbacks that are waiting or running, mapped to
+        # the ones still waiting
+        self._lock = threading.Lock()
+        self._queues = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ty, value, tb):
+        self.shutdown()
+
+    def dispatch(self, key, callback, *args):
+        self._slots.acquire()
+
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                # a worker is already handling this key and will get to
+                # it in order
+                queue.append((callback, args))
+                return
+
+            self._queues[key] = deque([(callback, args)])
+
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+
+                callback, args = queue.popleft()
+
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception('error in notification callback')
+            finally:
+                self._slots.release()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
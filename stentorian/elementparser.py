@@ -1,142 +1,221 @@
-from .grammar import (Alternative, Sequence, Repetition,
+import functools
+import re
+
+from .grammar import (Element, Alternative, Sequence, Repetition,
                       Optional, Word, Dictation, DictationWord,
                       SpellingLetter)
 
 
-class GrammarParser(object):
-    def __init__(self, s, extras):
-        self._s = s
-        self._pos = 0
+_TOKEN = re.compile(r'''
+    (?P<word>[^\W_]+)
+  | `(?P<quoted>[^`]*)`
+  | (?P<punct>[][()<>|*~])
+  | (?P<invalid>\S)
+    ''', re.VERBOSE)
 
-        self._extras = extras
+_SEQUENCE_START = frozenset(['word', '[', '<', '(', '~'])
 
-    def parse(self):
-        return self._element()
+# elements without any state can be shared between all specs
+_SPECIALS = {
+    'dictation': Dictation(),
+    'word': DictationWord(),
+    'letter': SpellingLetter(),
+}
 
-    def _skip_spaces(self):
-        while self._pos != len(self._s) and self._s[self._pos].isspace():
-            self._pos += 1
 
-    def _token(self, token):
-        t = self._next()
-        assert t == token
+def _tokenize(s):
+    tokens = []
+    for word, quoted, punct, invalid in _TOKEN.findall(s):
+        if word:
+            tokens.append(('word', word))
+        elif punct:
+            tokens.append((punct, None))
+        elif invalid:
+            raise ValueError('invalid grammar spec {!r}'.format(s))
+        else:
+            tokens.append(('word', quoted))
 
-    def _next(self, skip=True):
-        t = self._peek(skip)
-        if t is not None:
-            self._pos += 1
-        return t
+    tokens.append((None, None))
+    return tokens
+
+
+class _Extra(object):
+    # a reference to a capture in a parsed spec
+    def __init__(self, name):
+        self.name = name
+
+
+class GrammarParser(object):
+    # Parses a spec into a structure in which every part that doesn't
+    # refer to a capture is already a finished element, so it can be
+    # cached and shared. The remaining parts are tuples that are
+    # turned into elements once the captures are known.
 
-    def _peek(self, skip=True):
-        if self._pos == len(self._s):
-            return None
+    def __init__(self, s):
+        self._s = s
+        self._tokens = _tokenize(s)
+        self._pos = 0
 
-        if skip:
-            self._skip_spaces()
+    def parse(self):
+        structure = self._alternative()
+        if self._peek() is not None:
+            raise self._error()
+        return structure
 
-        return self._s[self._pos]
+    def _error(self):
+        return ValueError('invalid grammar spec {!r}'.format(self._s))
 
-    def _eof(self):
-        assert self._pos == len(self._s)
+    def _peek(self):
+        return self._tokens[self._pos][0]
 
-    def _element(self):
-        element = self._alternative()
-        self._eof()
-        return element
+    def _token(self, kind):
+        t, value = self._tokens[self._pos]
+        if t != kind:
+            raise self._error()
+        self._pos += 1
+        return value
 
     def _alternative(self):
-        options = []
-        options.append(self._sequence())
+        options = [self._sequence()]
         while self._peek() == '|':
-            self._token('|')
+            self._pos += 1
             options.append(self._sequence())
 
         if len(options) == 1:
             return options[0]
 
-        return Alternative(options)
+        return _node(Alternative, options)
 
     def _sequence(self):
-        children = []
-        children.append(self._mayberepetition())
-        sequence_start = set(['[', '<', '(', '`', '~'])
-        t = self._peek()
-        while t is not None and (t in sequence_start or t.isalnum()):
+        children = [self._mayberepetition()]
+        while self._peek() in _SEQUENCE_START:
             children.append(self._mayberepetition())
-            t = self._peek()
 
         if len(children) == 1:
             return children[0]
 
-        return Sequence(children)
+        return _node(Sequence, children)
 
     def _mayberepetition(self):
         child = self._atom()
         if self._peek() == '*':
-            self._token('*')
-            return Repetition(child)
+            self._pos += 1
+            return _node(Repetition, child)
 
         return child
 
     def _atom(self):
         t = self._peek()
-        if t == '[':
-            return self._optional()
+        if t == 'word':
+            return _caches.word(self._token('word'))
+        elif t == '[':
+            self._pos += 1
+            child = self._alternative()
+            self._token(']')
+            return _node(Optional, child)
         elif t == '<':
-            return self._extra()
+            self._pos += 1
+            name = self._token('word')
+            self._token('>')
+            return _Extra(name)
         elif t == '(':
-            self._token('(')
+            self._pos += 1
             a = self._alternative()
             self._token(')')
             return a
         elif t == '~':
-            return self._special()
-
-        return Word(self._word())
-
-    def _special(self):
-        self._token('~')
-        w = self._word()
-        rules = {
-            'dictation': Dictation(),
-            'word': DictationWord(),
-            'letter': SpellingLetter()
-        }
-        return rules[w]
-
-    def _optional(self):
-        self._token('[')
-        child = self._alternative()
-        self._token(']')
-        return Optional(child)
-
-    def _extra(self):
-        self._token('<')
-        w = self._word()
-        self._token('>')
-        return self._extras[w]
-
-    def _word(self):
-        t = self._peek()
+            self._pos += 1
+            name = self._token('word')
+            if name not in _SPECIALS:
+                raise self._error()
+            return _SPECIALS[name]
+
+        raise self._error()
+
+
+def _node(cls, children):
+    # builds the element right away if none of its parts refer to a
+    # capture
+    parts = children if isinstance(children, list) else [children]
+    if all(isinstance(p, Element) for p in parts):
+        return cls(children)
+
+    return (cls, children)
+
+
+def _build(structure, extras):
+    if isinstance(structure, Element):
+        return structure
+
+    if isinstance(structure, _Extra):
+        return extras[structure.name]
+
+    cls, children = structure
+    if isinstance(children, list):
+        return cls([_build(c, extras) for c in children])
+
+    return cls(_build(children, extras))
+
+
+def _parse(s):
+    return GrammarParser(s).parse()
+
+
+def _capture_names(s):
+    names = set()
+    to_visit = [_caches.parse(s)]
+    while to_visit:
+        structure = to_visit.pop()
+        if isinstance(structure, _Extra):
+            names.add(structure.name)
+        elif isinstance(structure, tuple):
+            children = structure[1]
+            if isinstance(children, list):
+                to_visit.extend(children)
+            else:
+                to_visit.append(children)
+
+    return frozenset(names)
+
+
+class _Caches(object):
+    # Parsed specs, and words, kept to be shared. Specs built from
+    # changing text, such as window titles, each take an entry, so the
+    # caches are bounded by default.
+    def __init__(self, maxsize):
+        self.set_size(maxsize)
+
+    def set_size(self, maxsize):
+        self.word = functools.lru_cache(maxsize=maxsize)(Word)
+        self.parse = functools.lru_cache(maxsize=maxsize)(_parse)
+        self.capture_names = functools.lru_cache(maxsize=maxsize)(
+            _capture_names)
+
+    def clear(self):
+        self.word.cache_clear()
+        self.parse.cache_clear()
+        self.capture_names.cache_clear()
+
+
+_caches = _Caches(65536)
+
+
+def set_cache_size(maxsize):
+    # the number of entries of each cache, or None for no limit; empties
+    # the caches
+    _caches.set_size(maxsize)
+
+
+def clear_caches():
+    _caches.clear()
 
-        if t == '`':
-            self._token('`')
-            word = []
-            while self._peek(skip=False) != '`':
-                word.append(self._next(skip=False))
-            self._token('`')
-            return ''.join(word)
 
-        word = []
-        t = self._peek(skip=False)
-        while t is not None and t.isalnum():
-            word.append(self._next(skip=False))
-            t = self._peek(skip=False)
-        return ''.join(word)
+def capture_names(s):
+    # the names of the captures referred to by a spec
+    return _caches.capture_names(s)
 
 
 def parse(s, extras=None):
     if extras is None:
         extras = {}
-    p = GrammarParser(s, extras)
-    return p.parse()
+    return _build(_caches.parse(s), extras)
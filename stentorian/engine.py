@@ -1,31 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import socket
 import time
 import functools
 import logging
+import random
 import threading
 
-from .protocol import LineProtocolClient, JsonRpcClient
+from .codec import Encoded
+from .dispatch import InlineDispatcher
+from .metrics import Metrics
+from .protocol import (LineProtocolClient, JsonRpcClient, BatchError,
+                       ConnectionLost, RequestTimeout, _deadline,
+                       _remaining)
+from .recording import RecordingTransport
+from . import transport as transports
 
 
 logger = logging.getLogger(__name__)
 
 
-def retry(exc, delay, tries, log):
+def _backoff(delay, max_delay=3, jitter=0.5):
+    # the delays between attempts, as described for retry()
+    while True:
+        yield delay * random.uniform(1 - jitter, 1)
+        delay = min(max_delay, delay * 2)
+
+
+def retry(exc, delay, tries, log, max_delay=3, jitter=0.5):
+    # Retries with exponential backoff. The first retry comes after
+    # delay, which is kept short in case the server is just starting
+    # up, and the delay doubles up to max_delay after that. The delays
+    # are randomly shortened by up to the jitter fraction, so that
+    # clients that lost the same server don't all reconnect at the same
+    # moment.
     def do_decorate(f):
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
+            waits = _backoff(delay, max_delay, jitter)
             for _ in range(tries - 1):
-                start = time.time()
+                start = time.monotonic()
                 try:
                     return f(*args, **kwargs)
                 except exc:
-                    elapsed = time.time() - start
-                    remaining = delay - elapsed
-                    if remaining > 0:
-                        time.sleep(remaining)
                     log.debug('call failed, retrying...', exc_info=True)
 
+                remaining = next(waits) - (time.monotonic() - start)
+                if remaining > 0:
+                    time.sleep(remaining)
+
             return f(*args, **kwargs)
 
         return wrapper
@@ -33,33 +56,74 @@ def retry(exc, delay, tries, log):
     return do_decorate
 
 
-@retry(OSError, delay=3, tries=100, log=logger)
-def _connect_socket(host, port, timeout):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        s.settimeout(timeout)
-        s.connect((host, port))
-        s.settimeout(None)
-        return s
-    except:
-        s.close()
-        raise
+@retry(OSError, delay=0.05, tries=100, log=logger)
+def _connect_socket(host, port, timeout, **options):
+    return transports.tcp(host, port, timeout, **options)
+
+
+@retry(OSError, delay=0.05, tries=100, log=logger)
+def _connect_unix_socket(path, timeout, **options):
+    return transports.unix(path, timeout, **options)
 
 
-def wait_for_user(engine):
+def wait_for_user(engine, max_interval=1):
+    # polls quickly at first, since the profile is usually being loaded
+    # already, and backs off to max_interval
+    interval = 0.02
     while engine.get_current_user() is None:
         logger.debug('get_current_user returned None, retrying...')
-        time.sleep(1)
+        time.sleep(interval)
+        interval = min(max_interval, interval * 2)
+
+
+@contextmanager
+def _timed(timings, phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = time.perf_counter() - start
+
+
+def _log_timings(message, timings):
+    logger.info('%s in %.0f ms (%s)', message,
+                sum(timings.values()) * 1e3,
+                ', '.join('{} {:.0f} ms'.format(phase, t * 1e3)
+                          for phase, t in timings.items()))
 
 
-def connect(host, port):
+def connect(host, port, reconnect=False, **options):
+    # options are socket options for transport.tcp, such as
+    # nodelay=False or send_buffer=2 ** 20
+    return _connect(
+        lambda: _connect_socket(host, port, timeout=2, **options),
+        reconnect)
+
+
+def connect_unix(path, reconnect=False, **options):
+    return _connect(
+        lambda: _connect_unix_socket(path, timeout=2, **options),
+        reconnect)
+
+
+def _connect(open_transport, reconnect):
+    timings = {}
+
     logger.info('attempting to connect to server')
-    s = _connect_socket(host, port, timeout=2)
+    with _timed(timings, 'connect'):
+        if reconnect:
+            engine = ReconnectingEngine(open_transport)
+        else:
+            engine = Engine(open_transport())
     logger.info('successfully connected to server')
-    engine = Engine(s)
+
     logger.info('waiting for user profile to be selected')
-    wait_for_user(engine)
+    with _timed(timings, 'wait_for_user'):
+        wait_for_user(engine)
     logger.info('user profile selected')
+
+    engine.startup_timings = timings
+    _log_timings('engine ready', timings)
     return engine
 
 
@@ -68,34 +132,109 @@ class CommandGrammarControl(object):
         self.grammar_id = grammar_id
         self.engine = engine
         self.rules = rules
+        self.grammar = None
+        self.load_call = None
+
+        # client-side record of the grammar's state on the server, used
+        # to restore it after reconnecting and to compute list updates.
+        # Lists map their name to an ordered set of words.
+        self.active_rules = set()
+        self.lists = {}
 
     def rule_activate(self, rule):
-        self.engine._request('command_grammar_rule_activate',
-                             self.grammar_id, rule.name)
+        # calls for rules that are already in the requested state are
+        # not sent to the server
+        if rule.name in self.active_rules:
+            return
+
+        self.engine._request_then(
+            functools.partial(self.active_rules.add, rule.name),
+            'command_grammar_rule_activate', self.grammar_id, rule.name)
 
     def rule_deactivate(self, rule):
-        self.engine._request('command_grammar_rule_deactivate',
-                             self.grammar_id, rule.name)
+        if rule.name not in self.active_rules:
+            return
+
+        self.engine._request_then(
+            functools.partial(self.active_rules.discard, rule.name),
+            'command_grammar_rule_deactivate', self.grammar_id, rule.name)
 
     def rule_activate_all(self):
-        for r in self.rules:
-            self.rule_activate(r)
+        self.set_active_rules(self.rules)
 
     def rule_deactivate_all(self):
-        for r in self.rules:
-            self.rule_deactivate(r)
+        self.set_active_rules([])
+
+    def set_active_rules(self, rules):
+        # activates exactly the given rules in a single batch
+        wanted = set(r.name for r in rules)
+
+        with self.engine.batch():
+            for r in self.rules:
+                if r.name not in wanted:
+                    self.rule_deactivate(r)
+
+            for r in rules:
+                self.rule_activate(r)
+
+    # the record of a list only changes once the server has accepted
+    # the change
 
     def list_append(self, grammar_list, word):
-        self.engine._request('command_grammar_list_append',
-                             self.grammar_id, grammar_list.name, word)
+        self.engine._request_then(
+            functools.partial(self._list_appended, grammar_list.name, word),
+            'command_grammar_list_append',
+            self.grammar_id, grammar_list.name, word)
 
     def list_remove(self, grammar_list, word):
-        self.engine._request('command_grammar_list_remove',
-                             self.grammar_id, grammar_list.name, word)
+        self.engine._request_then(
+            functools.partial(self._list_removed, grammar_list.name, word),
+            'command_grammar_list_remove',
+            self.grammar_id, grammar_list.name, word)
 
     def list_clear(self, grammar_list):
-        self.engine._request('command_grammar_list_clear',
-                             self.grammar_id, grammar_list.name)
+        self.engine._request_then(
+            functools.partial(self.lists.pop, grammar_list.name, None),
+            'command_grammar_list_clear',
+            self.grammar_id, grammar_list.name)
+
+    def _list_appended(self, name, word):
+        self.lists.setdefault(name, {})[word] = None
+
+    def _list_removed(self, name, word):
+        self.lists.get(name, {}).pop(word, None)
+
+    def list_set(self, grammar_list, words):
+        # Changes the contents of the list to words with as few requests
+        # as possible, based on what the list is known to contain, and
+        # sends them as one batch.
+        current = self.lists.get(grammar_list.name, {})
+        wanted = dict.fromkeys(words)
+
+        removed = [w for w in current if w not in wanted]
+        added = [w for w in wanted if w not in current]
+
+        with self.engine.batch():
+            if len(removed) + len(added) > len(wanted) + 1:
+                # starting over is cheaper than the difference
+                self.list_clear(grammar_list)
+                added = list(wanted)
+            else:
+                for word in removed:
+                    self.list_remove(grammar_list, word)
+
+            for word in added:
+                self.list_append(grammar_list, word)
+
+    def _replay(self):
+        for name in self.active_rules:
+            self.engine._request('command_grammar_rule_activate',
+                                 self.grammar_id, name)
+
+        for name, words in self.lists.items():
+            for word in words:
+                self.engine._request('command_grammar_list_append',
+                                     self.grammar_id, name, word)
 
     def unload(self):
         self.engine._command_grammar_unload(self.grammar_id)
@@ -105,30 +244,55 @@ class SelectGrammarControl(object):
     def __init__(self, engine, grammar_id):
         self.grammar_id = grammar_id
         self.engine = engine
+        self.load_call = None
+
+        self.active = False
+        self.text = None
 
     def activate(self):
-        self.engine._request('select_grammar_activate', self.grammar_id)
+        self.engine._request_then(
+            functools.partial(setattr, self, 'active', True),
+            'select_grammar_activate', self.grammar_id)
 
     def deactivate(self):
-        self.engine._request('select_grammar_deactivate', self.grammar_id)
+        self.engine._request_then(
+            functools.partial(setattr, self, 'active', False),
+            'select_grammar_deactivate', self.grammar_id)
 
     def text_set(self, text):
-        self.engine._request('select_grammar_text_set', self.grammar_id, text)
+        self.engine._request_then(
+            functools.partial(setattr, self, 'text', text),
+            'select_grammar_text_set', self.grammar_id, text)
 
     def text_get(self):
         return self.engine._request('select_grammar_text_get', self.grammar_id)
 
     def text_change(self, start, stop, text):
-        self.engine._request('select_grammar_text_change',
-                             self.grammar_id, start, stop, text)
+        self.engine._request_then(
+            functools.partial(self._edit, start, stop, text),
+            'select_grammar_text_change', self.grammar_id, start, stop, text)
 
     def text_insert(self, start, text):
-        self.engine._request('select_grammar_text_insert',
-                             self.grammar_id, start, text)
+        self.engine._request_then(
+            functools.partial(self._edit, start, start, text),
+            'select_grammar_text_insert', self.grammar_id, start, text)
 
     def text_delete(self, start, stop):
-        self.engine._request('select_grammar_text_delete',
-                             self.grammar_id, start, stop)
+        self.engine._request_then(
+            functools.partial(self._edit, start, stop, ''),
+            'select_grammar_text_delete', self.grammar_id, start, stop)
+
+    def _edit(self, start, stop, text):
+        if self.text is not None:
+            self.text = self.text[:start] + text + self.text[stop:]
+
+    def _replay(self):
+        if self.text is not None:
+            self.engine._request('select_grammar_text_set',
+                                 self.grammar_id, self.text)
+
+        if self.active:
+            self.engine._request('select_grammar_activate', self.grammar_id)
 
     def unload(self):
         self.engine._select_grammar_unload(self.grammar_id)
@@ -138,17 +302,35 @@ class DictationGrammarControl(object):
     def __init__(self, engine, grammar_id):
         self.grammar_id = grammar_id
         self.engine = engine
+        self.load_call = None
+
+        self.active = False
+        self.context_text = None
 
     def activate(self):
-        self.engine._request('dictation_grammar_activate', self.grammar_id)
+        self.engine._request_then(
+            functools.partial(setattr, self, 'active', True),
+            'dictation_grammar_activate', self.grammar_id)
 
     def deactivate(self):
-        self.engine._request('dictation_grammar_deactivate', self.grammar_id)
+        self.engine._request_then(
+            functools.partial(setattr, self, 'active', False),
+            'dictation_grammar_deactivate', self.grammar_id)
 
     def context(self, text):
-        self.engine._request(
+        self.engine._request_then(
+            functools.partial(setattr, self, 'context_text', text),
             'dictation_grammar_context_set', self.grammar_id, text)
 
+    def _replay(self):
+        if self.context_text is not None:
+            self.engine._request('dictation_grammar_context_set',
+                                 self.grammar_id, self.context_text)
+
+        if self.active:
+            self.engine._request('dictation_grammar_activate',
+                                 self.grammar_id)
+
     def unload(self):
         self.engine._dictation_grammar_unload(self.grammar_id)
 
@@ -157,12 +339,24 @@ class CatchallGrammarControl(object):
     def __init__(self, engine, grammar_id):
         self.grammar_id = grammar_id
         self.engine = engine
+        self.load_call = None
+
+        self.active = False
 
     def activate(self):
-        self.engine._request('catchall_grammar_activate', self.grammar_id)
+        self.engine._request_then(
+            functools.partial(setattr, self, 'active', True),
+            'catchall_grammar_activate', self.grammar_id)
 
     def deactivate(self):
-        self.engine._request('catchall_grammar_deactivate', self.grammar_id)
+        self.engine._request_then(
+            functools.partial(setattr, self, 'active', False),
+            'catchall_grammar_deactivate', self.grammar_id)
+
+    def _replay(self):
+        if self.active:
+            self.engine._request('catchall_grammar_activate',
+                                 self.grammar_id)
 
     def unload(self):
         self.engine._catchall_grammar_unload(self.grammar_id)
@@ -178,16 +372,53 @@ class EngineRegistration(object):
 
 
 class ParseTree(object):
+    # Children and words are only built when they are first needed,
+    # because most evaluations only look at part of the tree.
+    __slots__ = ('name', '_all_words', '_data', '_children', '_words')
+
     def __init__(self, all_words, data):
         self.name = data['name']
-        self._slice = data['slice']
         self._all_words = all_words
-        self.children = [ParseTree(all_words, c) for c in data['children']]
+        self._data = data
+        self._children = None
+        self._words = None
+
+    @property
+    def children(self):
+        if self._children is None:
+            all_words = self._all_words
+            self._children = [ParseTree(all_words, c)
+                              for c in self._data['children']]
+
+        return self._children
 
     @property
     def words(self):
-        start, stop = self._slice
-        return [w['text'] for w in self._all_words[start:stop]]
+        if self._words is None:
+            start, stop = self._data['slice']
+            self._words = tuple(w['text']
+                                for w in self._all_words[start:stop])
+
+        return self._words
+
+
+class ParseResult(ParseTree):
+    # The parse tree of the best match, which also gives access to the
+    # other matches the server reported for the same words.
+    __slots__ = ('_matches', '_alternatives')
+
+    def __init__(self, all_words, matches):
+        super().__init__(all_words, matches[0])
+        self._matches = matches
+        self._alternatives = None
+
+    @property
+    def alternatives(self):
+        if self._alternatives is None:
+            self._alternatives = [ParseTree(self._all_words, m)
+                                  for m in self._matches[1:]]
+
+        return self._alternatives
 
 
 class CallbackManager(object):
@@ -201,7 +432,7 @@ class CallbackManager(object):
         del self.callbacks[entity_id]
 
     def handle_callback(self, entity_id, event):
-        self.callbacks[entity_id](event)
+        return self.callbacks[entity_id](event)
 
 
 class GrammarCallback(object):
@@ -217,14 +448,35 @@ class GrammarCallback(object):
     def __call__(self, event):
         t = event['type']
         if t == 'phrase_start':
-            self.handler_object.phrase_start(self.control)
+            return self.handler_object.phrase_start(self.control)
         elif t == 'phrase_recognition_failure':
-            self.handler_object.phrase_recognition_failure(self.control)
+            return self.handler_object.phrase_recognition_failure(
+                self.control)
         elif t == 'phrase_finish':
-            self.handler_object.phrase_finish(
+            return self.handler_object.phrase_finish(
                 self.control,
                 (self.transform)(event['result']))
 
+        return None
+
+
+def _first_error(promises):
+    # the exception of the first of the calls that failed, if any
+    for p in promises:
+        try:
+            p.wait(0)
+        except ConnectionLost:
+            raise
+        except Exception as e:
+            return e
+
+    return None
+
+
+def make_parse_tree(event):
+    words, matches = event
+    return ParseResult(words, matches)
+
 
 def synchronize(f):
     @functools.wraps(f)
@@ -236,19 +488,39 @@ def synchronize(f):
 
 
 class Engine(object):
-    def __init__(self, s):
-        proto = LineProtocolClient(s)
-        client = JsonRpcClient(proto)
-        self.client = client
-        self.sock = s
+    # s is either a connected socket or a transport, such as one opened
+    # with the transport module or a ReplayTransport. With a
+    # SessionRecorder, all traffic is recorded.
+    def __init__(self, s, timeout=None, max_notifications=None,
+                 notification_policies=None, recorder=None):
+        self.timeout = timeout
+        self.max_notifications = max_notifications
+        self.notification_policies = notification_policies
+        self.recorder = recorder
+        # kept across reconnects
+        self.metrics = Metrics()
+        # seconds spent in each phase of the last connect or reconnect
+        self.startup_timings = {}
+        self.transport = None
+        self.client = None
+        self._attach(s)
 
         self._synchronize_lock = threading.RLock()
+        self._local = threading.local()
 
         self.command_grammars = CallbackManager()
         self.select_grammars = CallbackManager()
         self.dictation_grammars = CallbackManager()
         self.catchall_grammars = CallbackManager()
         self.engine_registrations = CallbackManager()
+        self.registrations = {}
+
+        self.grammar_managers = [
+            self.command_grammars,
+            self.select_grammars,
+            self.dictation_grammars,
+            self.catchall_grammars,
+        ]
 
         self.managers = {
             "command_grammar_notification": self.command_grammars,
@@ -258,104 +530,509 @@ class Engine(object):
             "engine_notification": self.engine_registrations,
         }
 
+    def _attach(self, s):
+        if self.transport is not None:
+            self.transport.close()
+
+        if isinstance(s, socket.socket):
+            transport = LineProtocolClient(transports.configure_socket(s))
+        else:
+            transport = s
+        if self.recorder is not None:
+            transport = RecordingTransport(transport, self.recorder)
+
+        self.transport = transport
+        self.client = JsonRpcClient(
+            transport, timeout=self.timeout,
+            max_notifications=self.max_notifications,
+            notification_policies=self.notification_policies,
+            metrics=self.metrics)
+
     def __enter__(self):
         return self
 
     def __exit__(self, ty, value, tb):
-        self.sock.close()
+        self.close()
+
+    def close(self):
+        # closing wakes up the receive thread, which then fails all
+        # outstanding requests
+        self.transport.close()
+
+    def cancel_all(self):
+        self.client.cancel_all()
+
+    def notification_stats(self):
+        # queue depth and the dropped, coalesced and overflowed
+        # notifications by event type
+        return self.client.notifications.stats()
+
+    def stats(self):
+        # A snapshot of the request counts and latencies by method,
+        # callback times by grammar, bytes on the wire and the state of
+        # the notification queue. Callbacks are keyed by notification
+        # method and grammar or registration id.
+        stats = self.metrics.snapshot()
+        stats['in_flight'] = self.client.in_flight()
+        stats['notifications'] = self.notification_stats()
+        stats['startup'] = dict(self.startup_timings)
+        return stats
+
+    def add_metrics_hook(self, hook):
+        # hook is a MetricsHook that gets every measurement as it is
+        # taken
+        self.metrics.add_hook(hook)
+
+    def remove_metrics_hook(self, hook):
+        self.metrics.remove_hook(hook)
+
+    def _current_batch(self):
+        return getattr(self._local, 'batch', None)
+
+    def batch(self):
+        # Collects the requests made by this thread inside the scope
+        # and sends them as a single JSON-RPC batch when it exits.
+        # Within the scope, requests return a Promise that is settled
+        # once the batch has been answered.
+        return self._batch(self.client.timeout)
+
+    @contextmanager
+    def _batch(self, timeout):
+        current = self._current_batch()
+        if current is not None:
+            yield current
+            return
+
+        b = self.client.batch()
+        self._local.batch = b
+        self._local.updates = updates = []
+        try:
+            yield b
+        except BaseException as e:
+            b.abort(e)
+            raise
+        finally:
+            self._local.batch = None
+            self._local.updates = None
+
+        b.send()
+        try:
+            b.wait(timeout)
+        finally:
+            # only the calls the server accepted are recorded
+            for promise, apply in updates:
+                if promise.succeeded():
+                    apply()
+
+    def submit(self, method, *args, **kwargs):
+        # send a request without waiting for its response; many
+        # submitted requests can be in flight at the same time
+        b = self._current_batch()
+        if b is not None:
+            return b.add(method, *args, **kwargs)
+
+        return self.client.request_async(method, *args, **kwargs)
+
+    def flush(self):
+        # sends submitted requests right away instead of leaving them to
+        # the sender thread
+        self.client.flush()
 
-    @synchronize
     def _request(self, *args, **kwargs):
+        b = self._current_batch()
+        if b is not None:
+            return b.add(*args, **kwargs)
+
         return self.client.request(*args, **kwargs)
 
-    @synchronize
+    def _request_then(self, apply, *args, **kwargs):
+        # Makes a request and calls apply() once it has succeeded, which
+        # in a batch is when the batch has been answered. Used to keep
+        # client-side records in step with the server.
+        b = self._current_batch()
+        if b is not None:
+            promise = b.add(*args, **kwargs)
+            self._local.updates.append((promise, apply))
+            return promise
+
+        result = self.client.request(*args, **kwargs)
+        apply()
+        return result
+
     def register(self, callback):
         e = self.client.request('engine_register')
-        self.engine_registrations.add_callback(e, callback)
-        return EngineRegistration(e, self.client, self.engine_registrations)
+        self._add_callback(self.engine_registrations, e, callback)
+        registration = EngineRegistration(e, self)
+        self.registrations[e] = registration
+        return registration
+
+    def _engine_unregister(self, engine_id):
+        self.client.request('engine_unregister', engine_id)
+        self._remove_callback(self.engine_registrations, engine_id)
+        del self.registrations[engine_id]
+
+    @synchronize
+    def _add_callback(self, manager, entity_id, callback):
+        manager.add_callback(entity_id, callback)
 
     @synchronize
+    def _remove_callback(self, manager, entity_id):
+        manager.remove_callback(entity_id)
+
     def command_grammar_load(self, grammar, callback):
-        g = self.client.request('command_grammar_load', grammar.serialize())
+        encoded = Encoded(grammar.encode(self.client.codec))
+        g = self.client.request('command_grammar_load', encoded)
+        control = self._command_grammar_loaded(grammar, callback, encoded, g)
+
+        with self.batch():
+            grammar.on_load(control)
 
-        def make_parse_tree(event):
-            words, matches = event
-            return ParseTree(words, matches[0])
+        return control
 
+    def _command_grammar_loaded(self, grammar, callback, encoded, g):
         rule_names = [r for r in grammar.rules if r.exported]
         control = CommandGrammarControl(self, g, rule_names)
+        control.load_call = ('command_grammar_load', (encoded,))
+        control.grammar = grammar
 
-        self.command_grammars.add_callback(
-            g, GrammarCallback(control, callback, transform=make_parse_tree))
-
-        grammar.on_load(control)
+        self._add_callback(
+            self.command_grammars, g,
+            GrammarCallback(control, callback, transform=make_parse_tree))
 
         return control
 
-    @synchronize
+    def load_grammars(self, grammars, max_workers=4):
+        # Loads many (grammar, callback) pairs at once: the grammars are
+        # serialized on a thread pool, all load requests go out in one
+        # batch and the initial list contents of all grammars in
+        # another, both within a single timeout. Returns the control of
+        # each grammar in the same order, or the exception that
+        # prevented it from loading; a failure doesn't affect the other
+        # grammars.
+        deadline = _deadline(self.timeout)
+
+        # the exception each grammar failed with, if any, until it is
+        # replaced by its control
+        results = [None] * len(grammars)
+        encoded = self._encode_grammars(grammars, results, max_workers)
+        controls = self._load_encoded(grammars, encoded, results, deadline)
+        spans, promises = self._run_on_load(controls, results, deadline)
+
+        for i, start, stop in spans:
+            if results[i] is None:
+                results[i] = _first_error(promises[start:stop])
+
+            if results[i] is None:
+                results[i] = controls[i]
+                continue
+
+            # don't leave a half set up grammar loaded
+            try:
+                controls[i].unload()
+            except ConnectionLost:
+                raise
+            except Exception:
+                logger.exception('failed to unload grammar')
+
+        return results
+
+    def _encode_grammars(self, grammars, results, max_workers):
+        codec = self.client.codec
+
+        def encode(grammar):
+            try:
+                return Encoded(grammar.encode(codec))
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            encoded = list(pool.map(encode, [g for g, _ in grammars]))
+
+        for i, e in enumerate(encoded):
+            if isinstance(e, Exception):
+                results[i] = e
+
+        return encoded
+
+    def _load_encoded(self, grammars, encoded, results, deadline):
+        # sends all loads in one batch; returns the controls by index
+        loads = self.client.batch()
+        promises = {}
+        for i, e in enumerate(encoded):
+            if results[i] is None:
+                promises[i] = loads.add('command_grammar_load', e)
+        loads.send()
+
+        controls = {}
+        for i, promise in promises.items():
+            if not promise.settled(_remaining(deadline)):
+                # The grammar may still be loaded after all, and would
+                # then be left on the server with nobody knowing its id,
+                # so it is unloaded once the id arrives.
+                promise.add_done_callback(self._unload_late)
+                results[i] = RequestTimeout(
+                    'no response within {} seconds'.format(self.timeout))
+                continue
+
+            try:
+                g = promise.wait()
+            except ConnectionLost:
+                raise
+            except Exception as e:
+                results[i] = e
+                continue
+
+            grammar, callback = grammars[i]
+            controls[i] = self._command_grammar_loaded(
+                grammar, callback, encoded[i], g)
+
+        return controls
+
+    def _unload_late(self, promise):
+        # runs on the receiving thread, so it doesn't wait for the
+        # response
+        if promise.succeeded():
+            try:
+                self.client.request_async('command_grammar_unload',
+                                          promise.wait())
+            except ConnectionLost:
+                pass
+
+    def _run_on_load(self, controls, results, deadline):
+        # Runs the on_load hooks of all grammars in one batch. Returns
+        # the span of the batch's calls made by each grammar, so that
+        # failures can be traced back to it, and the calls themselves.
+        spans = []
+        try:
+            with self._batch(_remaining(deadline)) as b:
+                for i, control in controls.items():
+                    start = len(b.promises)
+                    try:
+                        control.grammar.on_load(control)
+                    except Exception as e:
+                        results[i] = e
+                    spans.append((i, start, len(b.promises)))
+        except ConnectionLost:
+            raise
+        except Exception:
+            # failed calls or no answer in time; the calls that are
+            # still unanswered are given up
+            for p in b.promises:
+                p.cancel(RequestTimeout(
+                    'no response within {} seconds'.format(self.timeout)))
+
+        return spans, b.promises
+
+    def command_grammar_replace(self, control, grammar, callback):
+        # Skips the unload/load cycle when the grammar hasn't changed.
+        # The handlers may have, so the new grammar takes over the names
+        # of the loaded one and its callback replaces the old one.
+        if control.grammar.content_hash == grammar.content_hash:
+            grammar.adopt_names(control.grammar)
+            control.grammar = grammar
+            control.rules = [r for r in grammar.rules if r.exported]
+            self._add_callback(
+                self.command_grammars, control.grammar_id,
+                GrammarCallback(control, callback, transform=make_parse_tree))
+            return control
+
+        control.unload()
+        return self.command_grammar_load(grammar, callback)
+
     def _command_grammar_unload(self, grammar_id):
         self.client.request('command_grammar_unload', grammar_id)
-        self.command_grammars.remove_callback(grammar_id)
+        self._remove_callback(self.command_grammars, grammar_id)
 
-    @synchronize
     def select_grammar_load(self, select_words, through_words, callback):
         g = self.client.request('select_grammar_load',
                                 select_words, through_words)
 
         control = SelectGrammarControl(self, g)
+        control.load_call = ('select_grammar_load',
+                             (select_words, through_words))
 
-        self.select_grammars.add_callback(
-            g, GrammarCallback(control, callback))
+        self._add_callback(
+            self.select_grammars, g, GrammarCallback(control, callback))
 
         return control
 
-    @synchronize
     def _select_grammar_unload(self, grammar_id):
         self.client.request('select_grammar_unload', grammar_id)
-        self.select_grammars.remove_callback(grammar_id)
+        self._remove_callback(self.select_grammars, grammar_id)
 
-    @synchronize
     def dictation_grammar_load(self, callback):
         g = self.client.request('dictation_grammar_load')
         control = DictationGrammarControl(self, g)
-        self.dictation_grammars.add_callback(
-            g, GrammarCallback(control, callback))
+        control.load_call = ('dictation_grammar_load', ())
+        self._add_callback(
+            self.dictation_grammars, g, GrammarCallback(control, callback))
         return control
 
-    @synchronize
     def _dictation_grammar_unload(self, grammar_id):
         self.client.request('dictation_grammar_unload', grammar_id)
-        self.dictation_grammars.remove_callback(grammar_id)
+        self._remove_callback(self.dictation_grammars, grammar_id)
 
-    @synchronize
     def catchall_grammar_load(self, callback):
         g = self.client.request('catchall_grammar_load')
         control = CatchallGrammarControl(self, g)
-        self.catchall_grammars.add_callback(
-            g, GrammarCallback(control, callback))
+        control.load_call = ('catchall_grammar_load', ())
+        self._add_callback(
+            self.catchall_grammars, g, GrammarCallback(control, callback))
         return control
 
-    @synchronize
     def _catchall_grammar_unload(self, grammar_id):
         self.client.request('catchall_grammar_unload', grammar_id)
-        self.catchall_grammars.remove_callback(grammar_id)
+        self._remove_callback(self.catchall_grammars, grammar_id)
 
-    @synchronize
     def microphone_set_state(self, state):
         self.client.request('microphone_set_state', state)
 
-    @synchronize
     def microphone_get_state(self):
         return self.client.request('microphone_get_state')
 
-    @synchronize
     def get_current_user(self):
         return self.client.request('get_current_user')
 
-    def process_notifications(self):
+    def process_notifications(self, dispatcher=None):
+        # Callbacks run on this thread unless a dispatcher, such as a
+        # ParallelDispatcher, is given. Notifications for the same
+        # grammar or registration always reach it in order.
+        if dispatcher is None:
+            dispatcher = InlineDispatcher()
+
         while True:
             method, params = self.client.get_notification()
 
             cb_manager = self.managers[method]
             entity_id, event = params
-            cb_manager.handle_callback(entity_id, event)
+            with self._synchronize_lock:
+                callback = cb_manager.callbacks[entity_id]
+
+            key = (method, entity_id)
+            dispatcher.dispatch(key, self._run_callback, key, callback,
+                                event)
+
+    def _run_callback(self, key, callback, event):
+        start = time.perf_counter()
+        error = True
+        try:
+            callback(event)
+            error = False
+        finally:
+            self.metrics.callback_finished(
+                key, time.perf_counter() - start, error)
+
+    @synchronize
+    def _replay_session(self):
+        # Loads every grammar again in one pipelined burst, re-binds the
+        # existing controls to the new ids and then restores their
+        # state in a single batch. Nothing is changed until every
+        # reload has been answered, so that if the connection is lost
+        # again the whole session can be replayed once more.
+        reloads = []
+        for manager in self.grammar_managers:
+            for callback in manager.callbacks.values():
+                method, params = callback.control.load_call
+                reloads.append((manager, callback,
+                                self.client.request_async(method, *params)))
+
+        reregisters = []
+        for registration in self.registrations.values():
+            callback = self.engine_registrations.callbacks[
+                registration.engine_id]
+            reregisters.append((registration, callback,
+                                self.client.request_async('engine_register')))
+
+        reloaded = self._replay_results(reloads, 'reload grammar')
+        reregistered = self._replay_results(reregisters, 'register engine')
+
+        # the ids on the new connection may be any of the old ones, so
+        # the records are replaced rather than updated
+        for manager in self.grammar_managers:
+            manager.callbacks = {}
+        restored = []
+        for manager, callback, g in reloaded:
+            callback.control.grammar_id = g
+            manager.add_callback(g, callback)
+            restored.append(callback.control)
+
+        self.engine_registrations.callbacks = {}
+        self.registrations = {}
+        for registration, callback, e in reregistered:
+            registration.engine_id = e
+            self.engine_registrations.add_callback(e, callback)
+            self.registrations[e] = registration
+
+        try:
+            with self.batch():
+                for control in restored:
+                    control._replay()
+        except BatchError as e:
+            logger.error('failed to restore grammar state: %s', e)
+
+
+    def _replay_results(self, replays, what):
+        # (target, callback, result) for every replayed call that
+        # succeeded; a lost connection aborts the replay
+        results = []
+        for target, callback, promise in replays:
+            try:
+                results.append((target, callback, promise.wait(self.timeout)))
+            except ConnectionLost:
+                raise
+            except Exception:
+                logger.exception('failed to %s', what)
+
+        return results
+
+
+class ReconnectingEngine(Engine):
+    # An engine that reconnects when the connection to the server is
+    # lost and restores all grammars, their state and engine
+    # registrations. The reconnect happens in process_notifications;
+    # requests made while the connection is down fail with
+    # ConnectionLost. connect_socket returns a new socket or transport.
+    def __init__(self, connect_socket, **kwargs):
+        self._connect_socket = connect_socket
+        self._closing = False
+        super().__init__(connect_socket(), **kwargs)
+
+    def close(self):
+        self._closing = True
+        super().close()
+
+    def reconnect(self):
+        logger.info('reconnecting to server')
+        timings = {}
+        with self._synchronize_lock:
+            with _timed(timings, 'connect'):
+                self._attach(self._connect_socket())
+            with _timed(timings, 'wait_for_user'):
+                wait_for_user(self)
+            with _timed(timings, 'replay'):
+                self._replay_session()
+
+        self.startup_timings = timings
+        _log_timings('session restored', timings)
+
+    def process_notifications(self, dispatcher=None):
+        # the delays between attempts to restore the session while the
+        # connection keeps dropping, or None while connected
+        waits = None
+        while True:
+            try:
+                if waits is not None:
+                    self.reconnect()
+                    waits = None
+                super().process_notifications(dispatcher)
+            except ConnectionLost:
+                if self._closing:
+                    raise
+
+                if waits is None:
+                    logger.info('connection to server lost')
+                    waits = _backoff(0.05)
+                else:
+                    logger.warning('connection lost while restoring the '
+                                   'session, retrying', exc_info=True)
+                    time.sleep(next(waits))
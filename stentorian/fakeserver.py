@@ -0,0 +1,319 @@
+import argparse
+import itertools
+import logging
+import socket
+import threading
+import time
+
+from .codec import default_codec
+from .protocol import LineProtocolClient
+
+
+logger = logging.getLogger(__name__)
+
+
+# A stand-in for the Stentorian server that speaks the same
+# line-delimited JSON-RPC protocol. It keeps track of grammars, rules,
+# lists and registrations the way the server does, but never recognizes
+# anything by itself: notifications are sent by calling notify() and
+# friends. Meant for tests and for measuring the client without a
+# recognizer.
+
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+
+
+class ServerError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class _CommandGrammar(object):
+    def __init__(self, definition):
+        self.definition = definition
+        self.rules = set(r['name'] for r in definition['rules']
+                         if r['exported'])
+        self.active_rules = set()
+        self.lists = {}
+
+
+class _SimpleGrammar(object):
+    # select, dictation and catchall grammars
+    def __init__(self, select_words=None, through_words=None):
+        self.select_words = select_words
+        self.through_words = through_words
+        self.active = False
+        self.text = ''
+        self.context = None
+
+
+class FakeServer(object):
+    def __init__(self, sock, user='user', codec=None, latency=0):
+        self.transport = LineProtocolClient(sock)
+        self.codec = codec if codec is not None else default_codec()
+
+        # None while no user profile has been selected
+        self.user = user
+        # seconds to wait before answering each message
+        self.latency = latency
+
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.grammars = {}
+        self.registrations = set()
+        self.microphone_state = 'on'
+        self.requests = 0
+
+        self.methods = {
+            'get_current_user': self._get_current_user,
+            'microphone_set_state': self._microphone_set_state,
+            'microphone_get_state': self._microphone_get_state,
+            'engine_register': self._engine_register,
+            'engine_unregister': self._engine_unregister,
+            'command_grammar_load': self._command_grammar_load,
+            'command_grammar_unload': self._unload,
+            'command_grammar_rule_activate': self._rule_activate,
+            'command_grammar_rule_deactivate': self._rule_deactivate,
+            'command_grammar_list_append': self._list_append,
+            'command_grammar_list_remove': self._list_remove,
+            'command_grammar_list_clear': self._list_clear,
+            'select_grammar_load': self._select_grammar_load,
+            'select_grammar_unload': self._unload,
+            'select_grammar_activate': self._activate,
+            'select_grammar_deactivate': self._deactivate,
+            'select_grammar_text_set': self._text_set,
+            'select_grammar_text_get': self._text_get,
+            'select_grammar_text_change': self._text_change,
+            'select_grammar_text_insert': self._text_insert,
+            'select_grammar_text_delete': self._text_delete,
+            'dictation_grammar_load': self._simple_grammar_load,
+            'dictation_grammar_unload': self._unload,
+            'dictation_grammar_activate': self._activate,
+            'dictation_grammar_deactivate': self._deactivate,
+            'dictation_grammar_context_set': self._context_set,
+            'catchall_grammar_load': self._simple_grammar_load,
+            'catchall_grammar_unload': self._unload,
+            'catchall_grammar_activate': self._activate,
+            'catchall_grammar_deactivate': self._deactivate,
+        }
+
+    def serve(self):
+        # answers requests until the client disconnects
+        try:
+            while True:
+                messages = self.transport.receive_many()
+                if messages is None:
+                    break
+
+                # answered with a single write, like the server does
+                responses = [self._handle_message(msg) for msg in messages]
+                self.transport.send(b'\n'.join(responses), flush=True)
+        except OSError:
+            logger.debug('client connection closed', exc_info=True)
+
+    def close(self):
+        self.transport.close()
+
+    def _handle_message(self, msg):
+        if self.latency:
+            time.sleep(self.latency)
+
+        obj = self.codec.decode(msg)
+        if isinstance(obj, list):
+            response = [self._handle_request(r) for r in obj]
+        else:
+            response = self._handle_request(obj)
+
+        return self.codec.encode(response)
+
+    def _handle_request(self, request):
+        self.requests += 1
+
+        method = self.methods.get(request['method'])
+        try:
+            if method is None:
+                raise ServerError(METHOD_NOT_FOUND, 'method not found: {}'
+                                  .format(request['method']))
+
+            params = request.get('params', [])
+            with self.lock:
+                if isinstance(params, dict):
+                    result = method(**params)
+                else:
+                    result = method(*params)
+        except ServerError as e:
+            return {'jsonrpc': '2.0', 'id': request['id'],
+                    'error': {'code': e.code, 'message': e.message}}
+        except (TypeError, KeyError, ValueError) as e:
+            return {'jsonrpc': '2.0', 'id': request['id'],
+                    'error': {'code': INVALID_PARAMS, 'message': str(e)}}
+
+        return {'jsonrpc': '2.0', 'id': request['id'], 'result': result}
+
+    def _grammar(self, grammar_id, kind=None):
+        grammar = self.grammars.get(grammar_id)
+        if grammar is None or (kind is not None
+                               and not isinstance(grammar, kind)):
+            raise ServerError(INVALID_PARAMS,
+                              'no such grammar: {}'.format(grammar_id))
+        return grammar
+
+    def _get_current_user(self):
+        return self.user
+
+    def _microphone_set_state(self, state):
+        self.microphone_state = state
+
+    def _microphone_get_state(self):
+        return self.microphone_state
+
+    def _engine_register(self):
+        engine_id = next(self.ids)
+        self.registrations.add(engine_id)
+        return engine_id
+
+    def _engine_unregister(self, engine_id):
+        self.registrations.remove(engine_id)
+
+    def _command_grammar_load(self, definition):
+        grammar_id = next(self.ids)
+        self.grammars[grammar_id] = _CommandGrammar(definition)
+        return grammar_id
+
+    def _select_grammar_load(self, select_words, through_words):
+        grammar_id = next(self.ids)
+        self.grammars[grammar_id] = _SimpleGrammar(select_words,
+                                                   through_words)
+        return grammar_id
+
+    def _simple_grammar_load(self):
+        grammar_id = next(self.ids)
+        self.grammars[grammar_id] = _SimpleGrammar()
+        return grammar_id
+
+    def _unload(self, grammar_id):
+        self._grammar(grammar_id)
+        del self.grammars[grammar_id]
+
+    def _rule_activate(self, grammar_id, name):
+        grammar = self._grammar(grammar_id, _CommandGrammar)
+        if name not in grammar.rules:
+            raise ServerError(INVALID_PARAMS,
+                              'no such exported rule: {}'.format(name))
+        grammar.active_rules.add(name)
+
+    def _rule_deactivate(self, grammar_id, name):
+        grammar = self._grammar(grammar_id, _CommandGrammar)
+        grammar.active_rules.discard(name)
+
+    def _list_append(self, grammar_id, name, word):
+        grammar = self._grammar(grammar_id, _CommandGrammar)
+        grammar.lists.setdefault(name, []).append(word)
+
+    def _list_remove(self, grammar_id, name, word):
+        grammar = self._grammar(grammar_id, _CommandGrammar)
+        words = grammar.lists.get(name, [])
+        if word in words:
+            words.remove(word)
+
+    def _list_clear(self, grammar_id, name):
+        grammar = self._grammar(grammar_id, _CommandGrammar)
+        grammar.lists.pop(name, None)
+
+    def _activate(self, grammar_id):
+        self._grammar(grammar_id, _SimpleGrammar).active = True
+
+    def _deactivate(self, grammar_id):
+        self._grammar(grammar_id, _SimpleGrammar).active = False
+
+    def _text_set(self, grammar_id, text):
+        self._grammar(grammar_id, _SimpleGrammar).text = text
+
+    def _text_get(self, grammar_id):
+        return self._grammar(grammar_id, _SimpleGrammar).text
+
+    def _text_change(self, grammar_id, start, stop, text):
+        grammar = self._grammar(grammar_id, _SimpleGrammar)
+        grammar.text = grammar.text[:start] + text + grammar.text[stop:]
+
+    def _text_insert(self, grammar_id, start, text):
+        self._text_change(grammar_id, start, start, text)
+
+    def _text_delete(self, grammar_id, start, stop):
+        self._text_change(grammar_id, start, stop, '')
+
+    def _context_set(self, grammar_id, text):
+        self._grammar(grammar_id, _SimpleGrammar).context = text
+
+    # notifications
+
+    def notify(self, method, entity_id, event):
+        self.notify_many(method, entity_id, [event])
+
+    def notify_many(self, method, entity_id, events):
+        # sends all events at once, the way a burst would arrive from
+        # the server
+        lines = [self.codec.encode({
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': [entity_id, event],
+        }) for event in events]
+
+        self.transport.send(b'\n'.join(lines), flush=True)
+
+    def recognize(self, grammar_id, words, matches):
+        # A successful recognition by a command grammar. words are the
+        # recognized words as {"text": ..., "rule": ...} and matches
+        # the parse trees as the server reports them.
+        self.notify_many('command_grammar_notification', grammar_id, [
+            {'type': 'phrase_start'},
+            {'type': 'phrase_finish', 'result': [words, matches]},
+        ])
+
+    def reject(self, grammar_id):
+        self.notify_many('command_grammar_notification', grammar_id, [
+            {'type': 'phrase_start'},
+            {'type': 'phrase_recognition_failure'},
+        ])
+
+
+def start(**kwargs):
+    # A connected socket and the server on the other end of it, which
+    # runs on a background thread. The keyword arguments are passed to
+    # FakeServer.
+    client_sock, server_sock = socket.socketpair()
+    server = FakeServer(server_sock, **kwargs)
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+    return client_sock, server
+
+
+def serve_tcp(host, port, **kwargs):
+    # accepts any number of clients, each with a server of its own
+    listener = socket.create_server((host, port))
+    logger.info('listening on %s:%s', *listener.getsockname()[:2])
+
+    with listener:
+        while True:
+            sock, _address = listener.accept()
+            server = FakeServer(sock, **kwargs)
+            threading.Thread(target=server.serve, daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Stand-in Stentorian server for testing clients.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1337)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to wait before each response')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    serve_tcp(args.host, args.port, latency=args.latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,8 @@
+import hashlib
+import json
+import sys
+
+
 def collect_rule_dependencies(rules):
     # performs a topological sort to collect rule dependencies in
     # the proper order
@@ -25,7 +30,9 @@ def collect_rule_dependencies(rules):
             # the children of this node
             to_be_processed.append((True, current))
 
-            for d in set(current.referenced_rules()):
+            # in order of appearance rather than as a set, so that the
+            # same rules always end up in the same order
+            for d in dict.fromkeys(current.referenced_rules()):
                 if d in parents:
                     raise RuntimeError('cycle in grammar rules')
 
@@ -43,7 +50,19 @@ def wrap(name, child):
     }
 
 
+def _renamed(node, names):
+    # a copy of a serialized grammar with the given names replaced
+    if isinstance(node, list):
+        return [_renamed(c, names) for c in node]
+    if isinstance(node, dict):
+        return {k: names.get(v, v) if k == 'name' else _renamed(v, names)
+                for k, v in node.items()}
+    return node
+
+
 class ParseContext(object):
+    __slots__ = ('parse_tree', 'control', 'extras')
+
     def __init__(self, parse_tree, control, extras):
         self.parse_tree = parse_tree
         self.control = control
@@ -55,21 +74,125 @@ class ParseContext(object):
                 for c in self.parse_tree.children]
 
 
+class Compiler(object):
+    def __init__(self):
+        self.rule_evaluators = {}
+        self._compiled = {}
+
+    def compile(self, element):
+        # elements that are shared by many commands, such as captures,
+        # are only compiled once
+        evaluator = self._compiled.get(element)
+        if evaluator is None:
+            evaluator = element.compile(self)
+            self._compiled[element] = evaluator
+
+        return evaluator
+
+
 class Grammar(object):
     def __init__(self, rules):
         self.rules = collect_rule_dependencies(rules)
         self.rule_map = {r.name: r for r in self.rules}
 
+        # a grammar doesn't change once it has been built, so its wire
+        # form only needs to be computed once
+        self._serialized = None
+        self._encoded = {}
+        self._content_hash = None
+        self._evaluators = None
+
     def serialize(self):
-        serialized = {
-            "rules": [r.serialize() for r in self.rules]
-        }
+        if self._serialized is None:
+            self._serialized = {
+                "rules": [r.serialize() for r in self.rules]
+            }
+
+        return self._serialized
 
-        return serialized
+    def encode(self, codec):
+        data = self._encoded.get(codec.name)
+        if data is None:
+            data = codec.encode(self.serialize())
+            self._encoded[codec.name] = data
+
+        return data
+
+    @property
+    def content_hash(self):
+        # Identifies the structure of the grammar, independent of the
+        # codec in use. Rule and list names come from global counters,
+        # so they are replaced by their position first: two grammars
+        # built from the same definitions hash the same. The initial
+        # contents of the lists are included, since they are only sent
+        # when the grammar is loaded. Only computed when asked for, as
+        # it takes longer than encoding the grammar.
+        if self._content_hash is None:
+            lists = self._lists()
+            names = {r.name: 'rule_' + str(i)
+                     for i, r in enumerate(self.rules)}
+            for i, l in enumerate(lists):
+                names[l.name] = 'list_' + str(i)
+
+            # the serialized form always has its keys in the same order
+            canonical = json.dumps({
+                "rules": _renamed(self.serialize(), names),
+                "lists": [list(l.initial or ()) for l in lists],
+            }, separators=(',', ':'))
+            self._content_hash = hashlib.sha256(
+                canonical.encode('utf-8')).hexdigest()
+
+        return self._content_hash
+
+    def precompute(self, codec):
+        # computes the wire form now, rather than when the grammar is
+        # first loaded
+        return self.encode(codec)
+
+    def _lists(self):
+        return list(dict.fromkeys(
+            l for r in self.rules for l in r.referenced_lists()))
+
+    def adopt_names(self, other):
+        # Renames the rules and lists to those of other, which must have
+        # the same content hash, so that this grammar can take the place
+        # of other once it has been loaded.
+        for r, name in zip(self.rules, [r.name for r in other.rules]):
+            r.name = name
+        for l, name in zip(self._lists(), [l.name for l in other._lists()]):
+            l.name = name
+
+        self.rule_map = {r.name: r for r in self.rules}
+        self._serialized = None
+        self._encoded = {}
+        self._evaluators = None
+
+    def __getstate__(self):
+        # The evaluators are closures, which can't be pickled; they are
+        # compiled again when first needed. The wire form is kept
+        # encoded only, since the serialized form is much larger.
+        state = self.__dict__.copy()
+        state['_evaluators'] = None
+        if state['_encoded']:
+            state['_serialized'] = None
+        return state
+
+    def compile(self):
+        # Turns the element tree into evaluation closures once, so
+        # evaluating a result only touches the nodes of its parse tree.
+        # The rules are in dependency order, so referenced rules are
+        # compiled before the rules that use them.
+        if self._evaluators is None:
+            compiler = Compiler()
+            for r in self.rules:
+                compiler.rule_evaluators[r.name] = r.compile(compiler)
+            self._evaluators = compiler.rule_evaluators
+
+        return self._evaluators
 
     def value(self, context):
-        rule_name = context.parse_tree.name
-        return self.rule_map[rule_name].value(context)
+        tree = context.parse_tree
+        return self.compile()[tree.name](tree, context)
 
     def on_load(self, control):
         for r in self.rules:
@@ -80,6 +203,8 @@ class Grammar(object):
 
 
 class Rule(object):
+    __slots__ = ('name', 'exported', 'definition')
+
     rule_counter = 0
 
     def __init__(self, definition, exported):
@@ -98,9 +223,20 @@ class Rule(object):
     def value(self, context):
         return self.definition.value(context.children[0])
 
+    def compile(self, compiler):
+        definition = compiler.compile(self.definition)
+
+        def evaluate(tree, context):
+            return definition(tree.children[0], context)
+
+        return evaluate
+
     def referenced_rules(self):
         yield from self.definition.referenced_rules()
 
+    def referenced_lists(self):
+        yield from self.definition.referenced_lists()
+
     def on_load(self, control):
         self.definition._on_load_recursive(control)
 
@@ -109,20 +245,39 @@ class Rule(object):
         return self.name + exp + ' -> ' + self.definition.pretty(0) + ' ;'
 
 
+# Large grammars consist of very many elements, so they are kept
+# compact with __slots__.
+
 class Element(object):
+    __slots__ = ('children',)
+
     def __init__(self, children):
         self.children = children
 
     def map_value(self, handler):
-        return Map(lambda value, context: handler(value), self)
+        return Map(ValueHandler(handler), self)
 
     def map_full(self, handler):
         return Map(handler, self)
 
+    def compile(self, compiler):
+        # Compiled evaluators take a parse tree node and the context of
+        # the whole evaluation. Elements without a specialized version
+        # fall back to value().
+        def evaluate(tree, context):
+            return self.value(
+                ParseContext(tree, context.control, context.extras))
+
+        return evaluate
+
     def referenced_rules(self):
         for c in self.children:
             yield from c.referenced_rules()
 
+    def referenced_lists(self):
+        for c in self.children:
+            yield from c.referenced_lists()
+
     def on_load(self, control):
         pass
 
@@ -134,6 +289,8 @@ class Element(object):
 
 
 class Tag(Element):
+    __slots__ = ('name',)
+
     tag_counter = 0
 
     def __init__(self, child):
@@ -149,11 +306,36 @@ class Tag(Element):
         context.extras[self.name] = child_value
         return child_value
 
+    def compile(self, compiler):
+        child = compiler.compile(self.children[0])
+        name = self.name
+
+        def evaluate(tree, context):
+            child_value = child(tree, context)
+            context.extras[name] = child_value
+            return child_value
+
+        return evaluate
+
     def pretty(self, parent_prec):
         return self.children[0].pretty(parent_prec)
 
 
+class ValueHandler(object):
+    # a handler for map_value, which only gets the value; a class
+    # rather than a closure so that grammars can be pickled
+    __slots__ = ('handler',)
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __call__(self, value, _context):
+        return self.handler(value)
+
+
 class Map(Element):
+    __slots__ = ('handler',)
+
     def __init__(self, handler, child):
         super().__init__([child])
         self.handler = handler
@@ -165,11 +347,24 @@ class Map(Element):
         child_value = self.children[0].value(context)
         return self.handler(child_value, context)
 
+    def compile(self, compiler):
+        child = compiler.compile(self.children[0])
+        handler = self.handler
+
+        def evaluate(tree, context):
+            return handler(child(tree, context),
+                           ParseContext(tree, context.control,
+                                        context.extras))
+
+        return evaluate
+
     def pretty(self, parent_prec):
         return self.children[0].pretty(parent_prec)
 
 
 class Sequence(Element):
+    __slots__ = ()
+
     TAG = 'seq'
 
     def serialize(self):
@@ -184,6 +379,15 @@ class Sequence(Element):
 
         return child_values
 
+    def compile(self, compiler):
+        children = [compiler.compile(c) for c in self.children]
+
+        def evaluate(tree, context):
+            return [c(c_tree, context)
+                    for c, c_tree in zip(children, tree.children)]
+
+        return evaluate
+
     def pretty(self, parent_prec):
         prec = 2
         result = ' '.join(c.pretty(prec) for c in self.children)
@@ -194,6 +398,8 @@ class Sequence(Element):
 
 
 class Alternative(Element):
+    __slots__ = ()
+
     TAG = 'alt'
 
     def serialize(self):
@@ -209,6 +415,16 @@ class Alternative(Element):
 
         return self.children[i].value(context.children[0])
 
+    def compile(self, compiler):
+        # the branch is identified by the name of its capture
+        branches = {self.TAG + str(i): compiler.compile(c)
+                    for i, c in enumerate(self.children)}
+
+        def evaluate(tree, context):
+            return branches[tree.name](tree.children[0], context)
+
+        return evaluate
+
     def pretty(self, parent_prec):
         prec = 1
         result = ' | '.join(c.pretty(prec) for c in self.children)
@@ -219,6 +435,8 @@ class Alternative(Element):
 
 
 class Repetition(Element):
+    __slots__ = ()
+
     TAG = 'rep'
 
     def __init__(self, child):
@@ -235,6 +453,14 @@ class Repetition(Element):
         child_values = [child.value(c_parse) for c_parse in context.children]
         return child_values
 
+    def compile(self, compiler):
+        child = compiler.compile(self.children[0])
+
+        def evaluate(tree, context):
+            return [child(c_tree, context) for c_tree in tree.children]
+
+        return evaluate
+
     def pretty(self, parent_prec):
         prec = 3
         result = self.children[0].pretty(prec) + '*'
@@ -245,6 +471,8 @@ class Repetition(Element):
 
 
 class Optional(Element):
+    __slots__ = ('default',)
+
     TAG = 'opt'
 
     def __init__(self, child, default=None):
@@ -263,6 +491,18 @@ class Optional(Element):
 
         return self.children[0].value(context.children[0])
 
+    def compile(self, compiler):
+        child = compiler.compile(self.children[0])
+        default = self.default
+
+        def evaluate(tree, context):
+            if not tree.children:
+                return default
+
+            return child(tree.children[0], context)
+
+        return evaluate
+
     def pretty(self, _parent_prec):
         return '[' + self.children[0].pretty(0) + ']'
 
@@ -271,9 +511,21 @@ def leaf_wrap(child):
     return wrap('leaf', child)
 
 
+def single_word(tree, _context):
+    words = tree.words
+    assert len(words) == 1
+    return words[0]
+
+
+def all_words(tree, _context):
+    return tree.words
+
+
 class RuleRef(Element):
+    __slots__ = ('rule',)
+
     def __init__(self, rule):
-        super().__init__([])
+        super().__init__(())
         self.rule = rule
 
     def serialize(self):
@@ -285,6 +537,9 @@ class RuleRef(Element):
     def value(self, context):
         return self.rule.value(context)
 
+    def compile(self, compiler):
+        return compiler.rule_evaluators[self.rule.name]
+
     def referenced_rules(self):
         yield self.rule
 
@@ -293,9 +548,12 @@ class RuleRef(Element):
 
 
 class Word(Element):
+    __slots__ = ('text',)
+
     def __init__(self, text):
-        super().__init__([])
-        self.text = text
+        super().__init__(())
+        # the same words occur in many commands
+        self.text = sys.intern(text)
 
     def serialize(self):
         return leaf_wrap({
@@ -307,15 +565,20 @@ class Word(Element):
         assert len(context.parse_tree.words) == 1
         return context.parse_tree.words[0]
 
+    def compile(self, compiler):
+        return single_word
+
     def pretty(self, _parent_prec):
         return self.text
 
 
 class List(Element):
+    __slots__ = ('name', 'initial')
+
     counter = 0
 
     def __init__(self, initial=None):
-        super().__init__([])
+        super().__init__(())
         self.name = 'list_' + str(List.counter)
         self.initial = initial
         List.counter += 1
@@ -326,6 +589,9 @@ class List(Element):
             "name": self.name
         })
 
+    def referenced_lists(self):
+        yield self
+
     def value(self, context):
         assert len(context.parse_tree.words) == 1
         return context.parse_tree.words[0]
@@ -337,13 +603,18 @@ class List(Element):
         for word in self.initial:
             control.list_append(self, word)
 
+    def compile(self, compiler):
+        return single_word
+
     def pretty(self, _parent_prec):
         return '{' + self.name + '}'
 
 
 class Dictation(Element):
+    __slots__ = ()
+
     def __init__(self):
-        super().__init__([])
+        super().__init__(())
 
     def serialize(self):
         return leaf_wrap({
@@ -353,13 +624,18 @@ class Dictation(Element):
     def value(self, context):
         return context.parse_tree.words
 
+    def compile(self, compiler):
+        return all_words
+
     def pretty(self, _parent_prec):
         return '~dictation'
 
 
 class DictationWord(Element):
+    __slots__ = ()
+
     def __init__(self):
-        super().__init__([])
+        super().__init__(())
 
     def serialize(self):
         return leaf_wrap({
@@ -370,13 +646,18 @@ class DictationWord(Element):
         assert len(context.parse_tree.words) == 1
         return context.parse_tree.words[0]
 
+    def compile(self, compiler):
+        return single_word
+
     def pretty(self, _parent_prec):
         return '~word'
 
 
 class SpellingLetter(Element):
+    __slots__ = ()
+
     def __init__(self):
-        super().__init__([])
+        super().__init__(())
 
     def serialize(self):
         return leaf_wrap({
@@ -387,5 +668,8 @@ class SpellingLetter(Element):
         assert len(context.parse_tree.words) == 1
         return context.parse_tree.words[0]
 
+    def compile(self, compiler):
+        return single_word
+
     def pretty(self, _parent_prec):
         return '~letter'
@@ -0,0 +1,161 @@
+import bisect
+import threading
+
+
+# upper bounds in seconds of the latency buckets, from 100 microseconds
+# doubling up to about 100 seconds; anything slower goes in a last,
+# unbounded bucket
+LATENCY_BUCKETS = tuple(0.0001 * 2 ** i for i in range(21))
+
+
+class Histogram(object):
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        # the upper bound of the bucket the quantile falls in, which
+        # overestimates by at most a factor of two
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': [(bound, n) for bound, n
+                        in zip(self.bounds + (None,), self.counts) if n],
+        }
+
+
+class MetricsHook(object):
+    # Receives every measurement as it is taken, for exporting to
+    # another metrics system. Hooks are called on the thread that took
+    # the measurement, usually the receive thread, so they should be
+    # quick.
+    def call_finished(self, method, seconds, error):
+        pass
+
+    def callback_finished(self, key, seconds, error):
+        pass
+
+    def bytes_sent(self, n):
+        pass
+
+    def bytes_received(self, n):
+        pass
+
+
+class _MethodStats(object):
+    __slots__ = ('calls', 'errors', 'latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+    def snapshot(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'latency': self.latency.snapshot(),
+        }
+
+
+class Metrics(object):
+    # Counters for the requests made through a JsonRpcClient and the
+    # notification callbacks run by an Engine. Updates only take a
+    # lock and bump a few numbers, so they are cheap enough to be on
+    # all the time.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hooks = []
+
+        self.methods = {}
+        self.callbacks = {}
+        self.sent = 0
+        self.received = 0
+
+    def add_hook(self, hook):
+        self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook):
+        self._hooks = [h for h in self._hooks if h is not hook]
+
+    def call_started(self, method):
+        with self._lock:
+            stats = self.methods.get(method)
+            if stats is None:
+                stats = self.methods[method] = _MethodStats()
+            stats.calls += 1
+
+    def call_finished(self, method, seconds, error=False):
+        with self._lock:
+            stats = self.methods[method]
+            stats.latency.observe(seconds)
+            if error:
+                stats.errors += 1
+
+        for hook in self._hooks:
+            hook.call_finished(method, seconds, error)
+
+    def callback_finished(self, key, seconds, error=False):
+        with self._lock:
+            stats = self.callbacks.get(key)
+            if stats is None:
+                stats = self.callbacks[key] = _MethodStats()
+            stats.calls += 1
+            stats.latency.observe(seconds)
+            if error:
+                stats.errors += 1
+
+        for hook in self._hooks:
+            hook.callback_finished(key, seconds, error)
+
+    def bytes_sent(self, n):
+        with self._lock:
+            self.sent += n
+
+        for hook in self._hooks:
+            hook.bytes_sent(n)
+
+    def bytes_received(self, n):
+        with self._lock:
+            self.received += n
+
+        for hook in self._hooks:
+            hook.bytes_received(n)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'methods': {m: s.snapshot()
+                            for m, s in self.methods.items()},
+                'callbacks': {k: s.snapshot()
+                              for k, s in self.callbacks.items()},
+                'bytes_sent': self.sent,
+                'bytes_received': self.received,
+            }
@@ -0,0 +1,144 @@
+from collections import deque
+import threading
+
+
+# What to do with a notification, by event type, once the queue has a
+# maxsize. Without one, every notification is delivered as is.
+#
+# KEEP      always delivered. When the queue is full, a droppable
+#           notification is evicted to make room, and if there is none
+#           the queue grows beyond maxsize. The receiver never waits,
+#           since it also delivers the responses the consumer may be
+#           waiting for.
+# COALESCE  replaces a queued notification of the same type for the
+#           same grammar that hasn't been delivered yet, so a consumer
+#           that falls behind only sees the latest one. Dropped when the
+#           queue is full.
+# DROP      dropped when the queue is full.
+KEEP = 'keep'
+COALESCE = 'coalesce'
+DROP = 'drop'
+
+DEFAULT_POLICIES = {
+    'phrase_start': COALESCE,
+    'phrase_recognition_failure': COALESCE,
+    'phrase_finish': KEEP,
+}
+
+
+def _event_type(params):
+    try:
+        _entity_id, event = params
+        return event.get('type')
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+class NotificationQueue(object):
+    def __init__(self, maxsize=None, policies=None, default_policy=KEEP):
+        self.maxsize = maxsize
+        self.policies = dict(DEFAULT_POLICIES if policies is None
+                             else policies)
+        self.default_policy = default_policy
+
+        self._cond = threading.Condition()
+
+        # entries are [key, event type, policy, notification]; the last
+        # undelivered entry of each key is tracked for coalescing
+        self._entries = deque()
+        self._last = {}
+        self._closed = False
+
+        self.dropped = {}
+        self.coalesced = {}
+        # notifications queued beyond maxsize
+        self.overflowed = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, notification):
+        if notification is None:
+            # marks the end of the stream; never blocks or gets dropped
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            return
+
+        if self.maxsize is None:
+            with self._cond:
+                self._entries.append([None, None, KEEP, notification])
+                self._cond.notify()
+            return
+
+        method, params = notification
+        t = _event_type(params)
+        policy = self.policies.get(t, self.default_policy)
+        key = (method, params[0] if t is not None else None)
+
+        with self._cond:
+            last = self._last.get(key)
+            if policy == COALESCE and last is not None and last[1] == t:
+                last[3] = notification
+                _count(self.coalesced, t)
+                return
+
+            if not self._make_room(policy, t):
+                return
+
+            entry = [key, t, policy, notification]
+            self._entries.append(entry)
+            self._last[key] = entry
+            self._cond.notify()
+
+    def _make_room(self, policy, t):
+        # returns whether the new notification should be queued
+        if len(self._entries) < self.maxsize:
+            return True
+
+        if policy != KEEP:
+            _count(self.dropped, t)
+            return False
+
+        victim = next((e for e in self._entries if e[2] != KEEP), None)
+        if victim is None:
+            # only notifications that must not be lost are queued
+            _count(self.overflowed, t)
+            return True
+
+        self._remove(victim)
+        _count(self.dropped, victim[1])
+        return True
+
+    def _remove(self, entry):
+        self._entries.remove(entry)
+        if self._last.get(entry[0]) is entry:
+            del self._last[entry[0]]
+
+    def get(self):
+        # returns None once the stream has ended and everything before
+        # the end has been delivered
+        with self._cond:
+            while not self._entries:
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+            entry = self._entries.popleft()
+            if self._last.get(entry[0]) is entry:
+                del self._last[entry[0]]
+
+            return entry[3]
+
+    def stats(self):
+        with self._cond:
+            return {
+                'depth': len(self._entries),
+                'dropped': dict(self.dropped),
+                'coalesced': dict(self.coalesced),
+                'overflowed': dict(self.overflowed),
+            }
+
+
+def _count(counter, t):
+    counter[t] = counter.get(t, 0) + 1
@@ -1,22 +1,111 @@
-import json
+import functools
+import logging
+import socket
 import threading
-from queue import Queue
+import time
+
+from .codec import default_codec, Encoded
+from .metrics import Metrics
+from .notifications import NotificationQueue
+
+
+logger = logging.getLogger(__name__)
+
+# the most buffers a single sendmsg call accepts on common platforms
+_IOV_MAX = 1024
 
 
 class Promise(object):
     def __init__(self):
         self._value = None
+        self._error = None
         self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._canceller = None
+        self._callbacks = []
+
+        # what was called and when, for the latency metrics
+        self._method = None
+        self._started = None
+
+    def _settle(self, value, error):
+        # only the first outcome counts, so a late response cannot
+        # overwrite a timeout or cancellation
+        with self._lock:
+            if self._event.is_set():
+                return False
+
+            self._value = value
+            self._error = error
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            callback(self)
+
+        return True
+
+    def add_done_callback(self, callback):
+        # Calls callback(promise) once the outcome is known, right away
+        # if it already is. For responses, that happens on the thread
+        # that receives them, so the callback must not wait for another
+        # response.
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
 
     def resolve(self, value):
-        self._value = value
-        self._event.set()
+        return self._settle(value, None)
+
+    def reject(self, error):
+        return self._settle(None, error)
+
+    def cancel(self, error=None):
+        if error is None:
+            error = RequestCancelled('request was cancelled')
+
+        cancelled = self.reject(error)
+        if cancelled and self._canceller is not None:
+            self._canceller()
+
+        return cancelled
+
+    def done(self):
+        return self._event.is_set()
 
-    def wait(self):
-        self._event.wait()
+    def succeeded(self):
+        return self._event.is_set() and self._error is None
+
+    def settled(self, timeout=None):
+        # waits for the outcome like wait(), but without giving up the
+        # call when there is none in time; returns whether it arrived
+        return self._event.wait(timeout)
+
+    def wait(self, timeout=None):
+        if not self._event.wait(timeout):
+            self.cancel(RequestTimeout(
+                'no response within {} seconds'.format(timeout)))
+
+        if self._error is not None:
+            raise self._error
         return self._value
 
 
+class ConnectionLost(ConnectionError):
+    pass
+
+
+class RequestTimeout(TimeoutError):
+    pass
+
+
+class RequestCancelled(Exception):
+    pass
+
+
 class RemoteError(Exception):
     def __init__(self, code, message, data):
         super().__init__(message)
@@ -26,98 +115,499 @@ class RemoteError(Exception):
         self.data = data
 
 
+class BatchError(Exception):
+    def __init__(self, results):
+        self.results = results
+        self.errors = [(i, r) for i, r in enumerate(results)
+                       if isinstance(r, RemoteError)]
+
+        super().__init__('{} of {} batched calls failed'.format(
+            len(self.errors), len(results)))
+
+
+class Batch(object):
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+        self.promises = []
+        self.sent = False
+
+    def add(self, method, *args, **kwargs):
+        assert not args or not kwargs
+        return self.add_call(method, kwargs or args)
+
+    def add_call(self, method, params):
+        assert not self.sent
+
+        promise = Promise()
+        self.calls.append((method, params))
+        self.promises.append(promise)
+        return promise
+
+    def send(self, flush=True):
+        self.sent = True
+        if self.calls:
+            self.client._send_calls(self.calls, self.promises, batch=True,
+                                    flush=flush)
+
+    def abort(self, error):
+        self.sent = True
+        for p in self.promises:
+            p.reject(error)
+
+    def wait(self, timeout=None):
+        # the result of every call in order, with failed calls
+        # represented by their RemoteError
+        deadline = _deadline(timeout)
+
+        results = []
+        for p in self.promises:
+            try:
+                results.append(p.wait(_remaining(deadline)))
+            except RemoteError as e:
+                results.append(e)
+
+        if any(isinstance(r, RemoteError) for r in results):
+            raise BatchError(results)
+
+        return results
+
+
 class LineProtocolClient(object):
-    def __init__(self, sock):
+    def __init__(self, sock, buffer_size=65536, max_buffered=2 ** 20):
         self.socket = sock
-        self.buf = b''
 
-    def send(self, message):
-        message = message.encode('utf-8') + b'\n'
-        self.socket.sendall(message)
+        # Sent messages are queued and written by a sender thread,
+        # which gathers everything queued into a single sendmsg call.
+        # Flushing writes the queue out from the calling thread instead,
+        # for requests that are waited on right away. Whoever writes
+        # holds send_lock, so messages go out in order. Once more than
+        # max_buffered bytes are queued, send blocks.
+        self.send_lock = threading.Lock()
+        self.max_buffered = max_buffered
+        self._queue_lock = threading.Lock()
+        self._has_room = threading.Condition(self._queue_lock)
+        self._has_messages = threading.Condition(self._queue_lock)
+        self._outgoing = []
+        self._outgoing_size = 0
+        self._send_error = None
+        self._closing = False
+        self._sender = None
+
+        # Received data lives in buf[start:end]. Everything in
+        # buf[start:scan] is known not to contain a newline, so it
+        # isn't searched again when more data arrives.
+        self.buf = bytearray(buffer_size)
+        self.start = 0
+        self.scan = 0
+        self.end = 0
+
+    def send(self, message, flush=False):
+        if flush:
+            # written right here, after whatever is queued, without
+            # waking up the sender
+            self._drain([message, b'\n'])
+            return
+
+        with self._queue_lock:
+            if self._send_error is not None:
+                raise self._send_error
+
+            while self._outgoing_size >= self.max_buffered:
+                self._has_room.wait()
+                if self._send_error is not None:
+                    raise self._send_error
+
+            # the newline goes in a buffer of its own, so the message
+            # isn't copied
+            self._outgoing.append(message)
+            self._outgoing.append(b'\n')
+            self._outgoing_size += len(message) + 1
+
+            if self._sender is None:
+                self._sender = threading.Thread(
+                    target=self._send_worker, daemon=True,
+                    name='stentorian-sender')
+                self._sender.start()
+
+            self._has_messages.notify()
+
+    def flush(self):
+        # returns once everything sent so far has been written
+        self._drain()
+
+    def _send_worker(self):
+        while True:
+            with self._queue_lock:
+                while not self._outgoing and not self._closing:
+                    self._has_messages.wait()
+
+                if not self._outgoing:
+                    return
+
+            try:
+                self._drain()
+            except OSError:
+                logger.debug('sending to server failed', exc_info=True)
+                return
+
+    def _drain(self, extra=None):
+        with self.send_lock:
+            with self._queue_lock:
+                if self._send_error is not None:
+                    raise self._send_error
+
+                buffers = self._outgoing
+                if buffers:
+                    self._outgoing = []
+                    self._outgoing_size = 0
+                    # there is room for senders that were waiting
+                    self._has_room.notify_all()
+
+            if extra is not None:
+                buffers = buffers + extra
+            if not buffers:
+                return
+
+            try:
+                self._write(buffers)
+            except OSError as e:
+                with self._queue_lock:
+                    self._send_error = e
+                    self._has_room.notify_all()
+
+                # the connection is unusable, so make the receiver fail
+                # whatever is pending
+                self._shutdown()
+                raise
+
+    def _write(self, buffers):
+        if len(buffers) == 2 or not hasattr(self.socket, 'sendmsg'):
+            # copying a single message is cheaper than gathering it
+            self.socket.sendall(b''.join(buffers))
+            return
+
+        i = 0
+        while i < len(buffers):
+            n = self.socket.sendmsg(buffers[i:i + _IOV_MAX])
+
+            # skip what was written, which may end in the middle of a
+            # buffer
+            while n:
+                size = len(buffers[i])
+                if n < size:
+                    buffers[i] = memoryview(buffers[i])[n:]
+                    break
+                n -= size
+                i += 1
+
+    def _shutdown(self):
+        # wakes up a thread blocked in receive
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        # Whatever is still queued is written first, so requests that
+        # were sent without flushing aren't lost. That waits for the
+        # server to take them, unless the connection is already gone.
+        with self._queue_lock:
+            self._closing = True
+            self._has_messages.notify_all()
+
+        try:
+            self._drain()
+        except OSError:
+            logger.debug('sending to server failed', exc_info=True)
+
+        self._shutdown()
+        self.socket.close()
+
+    def _fill(self):
+        if self.end == len(self.buf):
+            pending = self.end - self.start
+            if self.start == 0:
+                # a single message is larger than the buffer
+                self.buf.extend(bytes(len(self.buf)))
+            else:
+                self.buf[:pending] = self.buf[self.start:self.end]
+                self.scan -= self.start
+                self.start = 0
+                self.end = pending
+
+        with memoryview(self.buf) as view:
+            n = self.socket.recv_into(view[self.end:])
+
+        self.end += n
+        return n
+
+    def _next_message(self):
+        i = self.buf.find(b'\n', self.scan, self.end)
+        if i == -1:
+            self.scan = self.end
+            return None
+
+        with memoryview(self.buf) as view:
+            msg = bytes(view[self.start:i])
+
+        if i + 1 == self.end:
+            # the buffer is drained, so start over at the front
+            self.start = self.scan = self.end = 0
+        else:
+            self.start = self.scan = i + 1
+
+        return msg
 
     def receive(self):
-        while b'\n' not in self.buf:
-            data = self.socket.recv(4096)
+        while True:
+            msg = self._next_message()
+            if msg is not None:
+                return msg
 
-            if not data:
+            if not self._fill():
                 return None
 
-            self.buf += data
+    def receive_many(self):
+        # Waits until at least one complete message is buffered and
+        # returns all of them, so a burst read by a single recv call is
+        # handed over at once. Returns None once the connection has
+        # been closed.
+        messages = []
+        msg = self._next_message()
+        while msg is None:
+            if not self._fill():
+                return None
+            msg = self._next_message()
 
-        msg, rest = self.buf.split(b'\n', 1)
-        self.buf = rest
+        while msg is not None:
+            messages.append(msg)
+            msg = self._next_message()
 
-        return msg.decode('utf-8')
+        return messages
 
 
 class JsonRpcClient(object):
-    def __init__(self, transport):
+    def __init__(self, transport, codec=None, timeout=None,
+                 max_notifications=None, notification_policies=None,
+                 metrics=None):
         self.transport = transport
-        self.notifications = Queue()
+        self.codec = codec if codec is not None else default_codec()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.notifications = NotificationQueue(
+            max_notifications, notification_policies)
+
+        # default deadline in seconds for blocking requests
+        self.timeout = timeout
 
         self.lock = threading.Lock()
         self.pending_calls = {}
         self.id_counter = 0
+        self.closed = False
 
         self.worker_thread = threading.Thread(
             target=self._receive_worker, daemon=True)
         self.worker_thread.start()
 
     def _receive_worker(self):
-        while True:
-            done = self._process_incoming()
-            if done:
-                return
+        try:
+            while True:
+                done = self._process_incoming()
+                if done:
+                    break
+        except OSError:
+            logger.debug('connection to server closed', exc_info=True)
+        except Exception:
+            logger.exception('error while receiving from server')
+        finally:
+            self._connection_lost()
+
+    def _connection_lost(self):
+        with self.lock:
+            self.closed = True
+            pending = list(self.pending_calls.values())
+            self.pending_calls.clear()
+
+        # fail everyone still waiting right away instead of letting
+        # them block forever
+        for promise in pending:
+            promise.reject(ConnectionLost('connection to server lost'))
+            self._call_finished(promise, True)
+
+        self.notifications.put(None)
 
     def _process_incoming(self):
-        msg = self.transport.receive()
-        if msg is None:
+        messages = self.transport.receive_many()
+        if messages is None:
             return True
-        obj = json.loads(msg)
 
-        if 'id' not in obj:
-            # it's a notification
-            self.notifications.put((obj['method'], obj['params']))
-        else:
-            msg_id = obj['id']
+        # including the newline of each message
+        self.metrics.bytes_received(
+            sum(len(msg) for msg in messages) + len(messages))
 
-            with self.lock:
-                self.pending_calls.pop(msg_id).resolve(obj)
+        for msg in messages:
+            self._process_message(msg)
 
         return False
 
-    def request(self, method, *args, **kwargs):
-        self.id_counter += 1
+    def _process_message(self, msg):
+        obj = self.codec.decode(msg)
 
-        assert not args or not kwargs
+        # a batch is answered with an array of responses
+        responses = obj if isinstance(obj, list) else [obj]
 
-        msg_id = self.id_counter
+        for r in responses:
+            if 'id' not in r:
+                # it's a notification
+                self.notifications.put((r['method'], r['params']))
+            else:
+                msg_id = r['id']
 
-        call = {
-            "jsonrpc": "2.0",
-            "method": method,
-            "params": kwargs or args,
-            "id": msg_id,
-        }
+                with self.lock:
+                    promise = self.pending_calls.pop(msg_id, None)
 
-        msg = json.dumps(call)
+                if promise is None:
+                    # the call timed out or was cancelled
+                    logger.debug('dropping response to call %s', msg_id)
+                    continue
 
-        promise = Promise()
+                _settle(promise, r)
+                self._call_finished(promise, 'error' in r)
+
+    def in_flight(self):
+        return len(self.pending_calls)
 
+    def _forget(self, msg_id):
+        # the call timed out or was cancelled, which counts as an error
         with self.lock:
-            self.pending_calls[msg_id] = promise
+            promise = self.pending_calls.pop(msg_id, None)
 
-        self.transport.send(msg)
+        if promise is not None:
+            self._call_finished(promise, True)
 
-        response = promise.wait()
+    def _call_finished(self, promise, error):
+        self.metrics.call_finished(
+            promise._method, time.perf_counter() - promise._started, error)
 
-        if 'result' in response:
-            return response['result']
-        else:
-            e = response['error']
-            raise RemoteError(code=e['code'],
-                              message=e['message'],
-                              data=e.get('data'))
+    def _send_calls(self, calls, promises, batch, flush=True):
+        with self.lock:
+            if self.closed:
+                raise ConnectionLost('connection to server lost')
+
+            ids = []
+            for promise in promises:
+                self.id_counter += 1
+                ids.append(self.id_counter)
+                self.pending_calls[self.id_counter] = promise
+                promise._canceller = functools.partial(
+                    self._forget, self.id_counter)
+
+        started = time.perf_counter()
+        for (method, _params), promise in zip(calls, promises):
+            self.metrics.call_started(method)
+            promise._method = method
+            promise._started = started
+
+        try:
+            encoded = [self._encode_call(method, params, msg_id)
+                       for (method, params), msg_id in zip(calls, ids)]
+
+            msg = b'[' + b','.join(encoded) + b']' if batch else encoded[0]
+            self.transport.send(msg, flush)
+        except:
+            with self.lock:
+                failed = [self.pending_calls.pop(msg_id, None)
+                          for msg_id in ids]
+            for promise in failed:
+                if promise is not None:
+                    self._call_finished(promise, True)
+            raise
+
+        self.metrics.bytes_sent(len(msg) + 1)
+
+    def _encode_call(self, method, params, msg_id):
+        if isinstance(params, dict) or \
+                not any(isinstance(p, Encoded) for p in params):
+            return self.codec.encode({
+                "jsonrpc": "2.0",
+                "method": method,
+                "params": params,
+                "id": msg_id,
+            })
+
+        encoded_params = [p.data if isinstance(p, Encoded)
+                          else self.codec.encode(p) for p in params]
+
+        return b''.join([
+            b'{"jsonrpc":"2.0","method":', self.codec.encode(method),
+            b',"params":[', b','.join(encoded_params),
+            b'],"id":', self.codec.encode(msg_id), b'}'])
+
+    def request_async(self, method, *args, **kwargs):
+        assert not args or not kwargs
+
+        # left for the sender thread, so that many calls made in a row
+        # go out together
+        return self._call(method, kwargs or args, flush=False)
+
+    def _call(self, method, params, flush):
+        promise = Promise()
+        self._send_calls([(method, params)], [promise], batch=False,
+                         flush=flush)
+        return promise
+
+    def request(self, method, *args, **kwargs):
+        assert not args or not kwargs
+        promise = self._call(method, kwargs or args, flush=True)
+        return promise.wait(self.timeout)
+
+    def flush(self):
+        # writes out requests made with request_async that may still
+        # be queued
+        self.transport.flush()
+
+    def batch(self):
+        return Batch(self)
+
+    def request_batch(self, calls):
+        b = self.batch()
+        for method, params in calls:
+            b.add_call(method, params)
+        b.send()
+        return b.wait(self.timeout)
+
+    def cancel_all(self, error=None):
+        with self.lock:
+            pending = list(self.pending_calls.values())
+
+        for promise in pending:
+            promise.cancel(error)
 
     def get_notification(self):
-        return self.notifications.get()
+        notification = self.notifications.get()
+        if notification is None:
+            raise ConnectionLost('connection to server lost')
+
+        return notification
+
+
+def _deadline(timeout):
+    if timeout is None:
+        return None
+    return time.monotonic() + timeout
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    return max(0, deadline - time.monotonic())
+
+
+def _settle(promise, response):
+    if 'result' in response:
+        promise.resolve(response['result'])
+    else:
+        e = response['error']
+        promise.reject(RemoteError(code=e['code'],
+                                   message=e['message'],
+                                   data=e.get('data')))
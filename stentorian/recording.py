@@ -0,0 +1,198 @@
+import gzip
+import threading
+import time
+
+
+# A session is recorded as one line per message:
+#
+#   <direction> <seconds since the start> <message>
+#
+# where the direction is '>' for messages sent to the server and '<'
+# for messages received from it. Messages never contain a newline, so
+# they are stored as they went over the wire. Files ending in .gz are
+# compressed.
+
+SENT = b'>'
+RECEIVED = b'<'
+
+
+def _open(path, mode):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class SessionRecorder(object):
+    # The file a session is recorded to. It is kept separate from the
+    # transport so that a reconnecting engine can keep recording to the
+    # same file.
+    def __init__(self, path):
+        self.file = _open(path, 'wb')
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ty, value, tb):
+        self.close()
+
+    def record(self, direction, messages):
+        prefix = b'%s %.6f ' % (direction, time.monotonic() - self.start)
+        data = b''.join(prefix + m + b'\n' for m in messages)
+        with self.lock:
+            self.file.write(data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class RecordingTransport(object):
+    # passes everything through to another transport and records it
+    def __init__(self, transport, recorder):
+        self.transport = transport
+        self.recorder = recorder
+
+    def send(self, message, flush=False):
+        # recorded first, so that the response can't end up before the
+        # request in the file
+        self.recorder.record(SENT, [message])
+        self.transport.send(message, flush)
+
+    def flush(self):
+        self.transport.flush()
+
+    def receive(self):
+        message = self.transport.receive()
+        if message is not None:
+            self.recorder.record(RECEIVED, [message])
+        return message
+
+    def receive_many(self):
+        messages = self.transport.receive_many()
+        if messages is not None:
+            self.recorder.record(RECEIVED, messages)
+        return messages
+
+    def close(self):
+        self.transport.close()
+
+
+def read_session(path):
+    # yields (direction, seconds, message) for every recorded message
+    with _open(path, 'rb') as f:
+        for line in f:
+            direction, t, message = line.rstrip(b'\n').split(b' ', 2)
+            yield direction, float(t), message
+
+
+class ReplayTransport(object):
+    # Plays back the messages received in a recorded session, at the
+    # original speed, speed times as fast, or as fast as possible when
+    # speed is None. What is sent is discarded.
+    #
+    # When wait_for_requests is set, a message is only delivered after
+    # as many requests have been sent as had been before it in the
+    # recording, so responses don't arrive before the calls they
+    # answer. That requires the client to make the same requests as in
+    # the recorded session; to replay only the notifications, without
+    # loading grammars first, turn it off.
+    def __init__(self, path, speed=1.0, wait_for_requests=True):
+        self.speed = speed
+        self.wait_for_requests = wait_for_requests
+
+        self._cond = threading.Condition()
+        self._sent = 0
+        self._closed = False
+
+        self._records = self._received(read_session(path))
+        self._next = next(self._records, None)
+        # the wall clock time corresponding to the start of the
+        # recording; set when the first message is read
+        self._base = None
+
+    def _received(self, records):
+        # received messages with the number of requests sent before them
+        sent = 0
+        for direction, t, message in records:
+            if direction == SENT:
+                sent += 1
+            else:
+                yield t, sent, message
+
+    def send(self, message, flush=False):
+        with self._cond:
+            if self._closed:
+                raise BrokenPipeError('replay transport is closed')
+            self._sent += 1
+            self._cond.notify_all()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def receive(self):
+        with self._cond:
+            if not self._ready(block=True):
+                return None
+            return self._advance()
+
+    def receive_many(self):
+        # everything that is due at once, like a burst read from a
+        # socket
+        with self._cond:
+            if not self._ready(block=True):
+                return None
+
+            messages = [self._advance()]
+            while self._ready(block=False):
+                messages.append(self._advance())
+
+            return messages
+
+    def _advance(self):
+        message = self._next[2]
+        self._next = next(self._records, None)
+        return message
+
+    def _ready(self, block):
+        # whether the next message can be delivered, waiting for it if
+        # block is set; False at the end of the recording
+        if self._base is None:
+            self._base = time.monotonic()
+
+        while True:
+            if self._closed or self._next is None:
+                return False
+
+            t, sent_before, _message = self._next
+
+            if self.wait_for_requests and self._sent < sent_before:
+                if not block:
+                    return False
+                self._cond.wait()
+                # the client was slower than in the recording, so move
+                # the rest of the session back accordingly
+                self._shift(t)
+                continue
+
+            if self.speed is None:
+                return True
+
+            delay = self._base + t / self.speed - time.monotonic()
+            if delay <= 0:
+                return True
+            if not block:
+                return False
+            self._cond.wait(delay)
+
+    def _shift(self, t):
+        if self.speed is not None:
+            late = time.monotonic() - (self._base + t / self.speed)
+            if late > 0:
+                self._base += late
@@ -0,0 +1,86 @@
+import socket
+
+from .protocol import LineProtocolClient
+
+
+# A transport carries whole messages between the client and the server.
+# It has send(message, flush=False), which may queue the message unless
+# flush is set, flush(), which returns once everything has been written,
+# receive() and receive_many(), which return None once the connection is
+# closed, and close(). LineProtocolClient is the transport for stream
+# sockets; the functions below open one over TCP, a Unix domain socket
+# or a socket pair, with the socket options tuned for many small
+# requests.
+
+def configure_socket(sock, nodelay=True, keepalive=True, send_buffer=None,
+                     receive_buffer=None):
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        if nodelay:
+            # requests are small and latency matters more than
+            # throughput, so don't let Nagle's algorithm hold them back
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    if send_buffer is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+    if receive_buffer is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+
+    return sock
+
+
+def _connected(sock, address, timeout, options):
+    try:
+        configure_socket(sock, **options)
+        sock.settimeout(timeout)
+        sock.connect(address)
+        sock.settimeout(None)
+        return sock
+    except:
+        sock.close()
+        raise
+
+
+def tcp_socket(host, port, timeout=None, **options):
+    # the first address that accepts the connection, IPv4 or IPv6
+    error = None
+    for family, type_, proto, _name, address in socket.getaddrinfo(
+            host, port, type=socket.SOCK_STREAM):
+        try:
+            return _connected(socket.socket(family, type_, proto), address,
+                              timeout, options)
+        except OSError as e:
+            error = e
+
+    if error is None:
+        error = OSError('no addresses for {}:{}'.format(host, port))
+    raise error
+
+
+def unix_socket(path, timeout=None, **options):
+    return _connected(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM),
+                      path, timeout, options)
+
+
+def socket_pair(**options):
+    a, b = socket.socketpair()
+    return configure_socket(a, **options), b
+
+
+def tcp(host, port, timeout=None, buffer_size=65536, **options):
+    return LineProtocolClient(tcp_socket(host, port, timeout, **options),
+                              buffer_size)
+
+
+def unix(path, timeout=None, buffer_size=65536, **options):
+    # for a server on the same machine, skipping the TCP stack
+    return LineProtocolClient(unix_socket(path, timeout, **options),
+                              buffer_size)
+
+
+def pair(buffer_size=65536, **options):
+    # a transport and the socket at the other end of it, for tests and
+    # for servers running in the same process
+    a, b = socket_pair(**options)
+    return LineProtocolClient(a, buffer_size), b
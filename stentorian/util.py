@@ -1,6 +1,8 @@
 import functools
+import operator
 
-from .grammar import Alternative, Optional, Tag, Sequence, ParseContext
+from .grammar import (Alternative, Optional, Tag, Sequence, Map, Word,
+                      ParseContext)
 from . import elementparser
 
 
@@ -52,25 +54,35 @@ def command(spec, handler, captures=None):
     return _command(spec, handler, tagged)
 
 
-def _command(spec, handler, tagged):
-    element = elementparser.parse(spec, tagged)
-
-    def new_handler(_child_value, context, h=handler):
-        capture_values = {k: context.extras[t.name]
-                          for k, t in tagged.items()
-                          if t.name in context.extras}
+class CommandHandler(object):
+    def __init__(self, handler, captures):
+        self.handler = handler
+        # (capture name, tag name) for the captures used by the command
+        self.captures = captures
 
-        for t in tagged.values():
-            context.extras.pop(t.name, None)
+    def __call__(self, _child_value, context):
+        extras = context.extras
+        capture_values = {k: extras.pop(tag_name)
+                          for k, tag_name in self.captures
+                          if tag_name in extras}
 
         capture_values['_control'] = context.control
 
-        return h(capture_values)
+        return self.handler(capture_values)
+
+
+def _command(spec, handler, tagged):
+    element = elementparser.parse(spec, tagged)
+
+    # only look up the captures that appear in this command, instead of
+    # every capture of the mapping
+    used = elementparser.capture_names(spec)
+    captures = [(k, t.name) for k, t in tagged.items() if k in used]
 
-    return element.map_full(new_handler)
+    return element.map_full(CommandHandler(handler, captures))
 
 
-def mapping(commands, captures=None):
+def mapping(commands, captures=None, factor=False):
     if captures is None:
         captures = {}
 
@@ -79,18 +91,179 @@ def mapping(commands, captures=None):
     alternatives = [_command(spec, handler, tagged)
                     for spec, handler in commands.items()]
 
-    return Alternative(alternatives)
+    result = Alternative(alternatives)
+    if factor:
+        result = factor_prefixes(result)
+
+    return result
+
+
+class Constant(object):
+    # a handler that always returns the same value
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, _captures):
+        return self.value
+
+
+def choice(cs, factor=False):
+    return mapping({k: Constant(v) for k, v in cs.items()}, factor=factor)
+
+
+# Factoring shared prefixes
+#
+# A mapping is an alternative of commands, and many of them start with
+# the same words. factor_prefixes turns those into a trie, so that for
+# example "go to line <n>" and "go to file <f>" become
+# "go to (line <n> | file <f>)". The handler of each command still gets
+# the value it would have gotten without factoring: every branch of the
+# trie produces a PendingCommand, which collects the values of the
+# factored words on its way up and is only handed to the command's
+# handler at the top.
+
+class PendingCommand(object):
+    def __init__(self, handler, is_sequence, values):
+        self.handler = handler
+        self.is_sequence = is_sequence
+        self.values = values
+
+    def finish(self, context):
+        value = self.values if self.is_sequence else self.values[0]
+        return self.handler(value, context)
+
+
+class StartCommand(object):
+    # the rest of a command after its factored prefix
+    def __init__(self, handler, is_sequence):
+        self.handler = handler
+        self.is_sequence = is_sequence
+
+    def __call__(self, values, _context):
+        return PendingCommand(self.handler, self.is_sequence, values)
+
+
+class PrefixWord(object):
+    # a word shared by several commands, optionally ending one of them
+    def __init__(self, handler=None, is_sequence=True):
+        self.handler = handler
+        self.is_sequence = is_sequence
+
+    def __call__(self, value, _context):
+        word, pending = value
+        if pending is None:
+            return PendingCommand(self.handler, self.is_sequence, [word])
+
+        pending.values.insert(0, word)
+        return pending
+
+
+class FinishCommand(object):
+    def __call__(self, value, context):
+        if isinstance(value, PendingCommand):
+            return value.finish(context)
+
+        return value
+
+
+class _Branch(object):
+    def __init__(self, items, handler, is_sequence, original=None):
+        self.items = items
+        self.handler = handler
+        self.is_sequence = is_sequence
+        # the unfactored command, for branches at the top of the trie
+        self.original = original
+
+    def unfactored(self):
+        if self.original is not None:
+            return self.original
+
+        return Sequence(self.items).map_full(
+            StartCommand(self.handler, self.is_sequence))
+
+
+def _leading_word(branch):
+    if branch.items and isinstance(branch.items[0], Word):
+        return branch.items[0].text
+
+    return None
+
+
+def _group_by_leading_word(branches):
+    groups = {}
+    ordered = []
+    for b in branches:
+        key = _leading_word(b)
+        if key is None:
+            ordered.append([b])
+        elif key in groups:
+            groups[key].append(b)
+        else:
+            groups[key] = [b]
+            ordered.append(groups[key])
+
+    return ordered
+
+
+def _factor(branches):
+    options = []
+    for group in _group_by_leading_word(branches):
+        if len(group) == 1:
+            options.append(group[0].unfactored())
+            continue
+
+        rest = [_Branch(b.items[1:], b.handler, b.is_sequence) for b in group]
+        ending = [b for b in rest if not b.items]
+        continuing = [b for b in rest if b.items]
+
+        if len(ending) > 1 or not continuing:
+            # several commands that are the same up to here can't be
+            # told apart, so leave them as they are
+            options.extend(b.unfactored() for b in group)
+            continue
+
+        inner = _factor(continuing)
+        inner = inner[0] if len(inner) == 1 else Alternative(inner)
+
+        if ending:
+            inner = Optional(inner)
+            handler = PrefixWord(ending[0].handler, ending[0].is_sequence)
+        else:
+            handler = PrefixWord()
+
+        options.append(Sequence([group[0].items[0], inner]).map_full(handler))
+
+    return options
+
+
+def factor_prefixes(alternative):
+    # Only commands produced by mapping(), whose element is a sequence
+    # or a single element with a handler, take part in factoring.
+    branches = []
+    others = []
+    for c in alternative.children:
+        if not isinstance(c, Map):
+            others.append(c)
+            continue
 
+        element = c.children[0]
+        if isinstance(element, Sequence):
+            branches.append(_Branch(list(element.children), c.handler,
+                                    True, original=c))
+        else:
+            branches.append(_Branch([element], c.handler, False, original=c))
 
-def choice(cs):
-    return mapping({k: lambda _e, v=v: v for k, v in cs.items()})
+    # commands that share no prefix with others stay as they were, and
+    # their values are passed through by FinishCommand
+    return Alternative(_factor(branches) + others).map_full(FinishCommand())
 
 
 def flag(spec):
     element = elementparser.parse(spec)
-    return Optional(element.map_value(lambda v: True), default=False)
+    return Optional(element.map_value(Constant(True)), default=False)
 
 
 def prefix(spec, element):
     prefix_element = elementparser.parse(spec)
-    return Sequence([prefix_element, element]).map_value(lambda vs: vs[1])
+    return Sequence([prefix_element, element]).map_value(
+        operator.itemgetter(1))